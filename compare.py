@@ -0,0 +1,66 @@
+"""Compare the throughput and the detection statistics of trained networks.
+
+    Each configuration file specifies a trained network (for example with a different base network or input size)
+    through model_name in its eval section. The networks detect the objects of the same subset of images of their
+    dataset and the throughput in images/s and the precision/recall of each class are printed and saved.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+from data import build_dataset, BaseTransform
+from data.config import build_config, reformat_json
+from ssd import base_network_name
+from utils.evaluation import detection_statistics
+from utils.inference import collect_detections, load_network
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector Comparison')
+parser.add_argument('--configs', type=str, nargs='+',
+                    help='Names of the configuration files of the networks.')
+parser.add_argument('--num_images', default=100, type=int,
+                    help='Number of images, randomly selected in the dataset, on which the networks are compared')
+parser.add_argument('--output', default='comparison_report.json', type=str,
+                    help='Path of the comparison report.')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    report = {}
+    for config_name in args.configs:
+        configs = build_config(config_name)
+
+        # Load neural net.
+        net = load_network(configs)
+
+        dataset = build_dataset(configs.dataset,
+                                transform=BaseTransform(configs.model.input_size, configs.model.pixel_means))
+        indices = np.random.RandomState(0).permutation(len(dataset))[:args.num_images].tolist()
+
+        # Warm up on the first batch, then time the detection of all images.
+        collect_detections(configs, net, dataset, indices[:configs.eval.batch_size])
+        start = time.perf_counter()
+        all_detections = collect_detections(configs, net, dataset, indices)
+        throughput = len(indices) / (time.perf_counter() - start)
+
+        network_report = {'model_name': configs.eval.model_name,
+                          'basenet': base_network_name(configs.model.basenet),
+                          'input_size': configs.model.input_size, 'images': len(indices),
+                          'images_per_s': throughput}
+        print('{}: {} base network, input size {}, {:.2f} images/s'.format(
+            config_name, network_report['basenet'], configs.model.input_size, throughput))
+        classes_statistics = detection_statistics(all_detections, [dataset.get_gt(i) for i in indices],
+                                                  [dataset.filenames[i] for i in indices],
+                                                  configs.model.num_classes)
+        if classes_statistics is not None:
+            for class_name, stats in zip(dataset.classes_name, classes_statistics):
+                network_report[class_name] = {name: stats[name] for name in ('Precision', 'Recall')}
+                print('    {}: precision {:.4f}, recall {:.4f}'.format(class_name, stats['Precision'],
+                                                                       stats['Recall']))
+        else:
+            print("    No ground truths were found.")
+        report[config_name] = network_report
+
+    with open(args.output, 'w') as file:
+        file.write(reformat_json(json.dumps(report, indent=4)))
+    print('Saved the comparison report in {}'.format(args.output))
@@ -1,5 +1,4 @@
 import os, sys
-import csv
 import os.path as osp
 
 import torch
@@ -8,11 +7,16 @@ import cv2
 import numpy as np
 import re
 from .config import dataset
+from .image_cache import ImageCache
+from .annotations import AnnotationIndex
 from utils.augmentations import ToPercentCoords
 
 # Pattern used to assign ID number to an image. If the pattern is not found, the alphabetical order is used instead.
 FILENAME_ID_PATTERN = '\d+'
 
+# Filename of the annotation index saved in the dataset directory.
+ANNOTATION_INDEX_FILENAME = 'bounding_boxes_index.npz'
+
 
 class TreeDataset(data.Dataset):
     """Tree Detection Dataset Object
@@ -34,25 +38,36 @@ class TreeDataset(data.Dataset):
         self.object_properties_name = config.object_properties
 
         self.transform = transform
+        self.image_cache = None
 
-        # Get all .jpg filenames in the image directory
-        self.filenames = list()
-        for root, dirs, files in os.walk(self.images_dir):
-            for file in files:
-                if file.endswith('.jpg'):
-                    self.filenames.append(osp.splitext(file)[0])
+        # Get all image filenames of the dataset.
+        self.filenames = self.find_filenames()
 
         # Sort the filenames in ascending tree ID
         self.filenames.sort(key=self.filename_to_ID)
         self.IDs = self.filename_to_ID(self.filenames)
 
+        # Read the ground truth objects of all images once.
+        self.annotations = self.load_annotations()
+
+    def find_filenames(self):
+        # Get all .jpg filenames in the image directory
+        filenames = list()
+        for root, dirs, files in os.walk(self.images_dir):
+            for file in files:
+                if file.endswith('.jpg'):
+                    filenames.append(osp.splitext(file)[0])
+        return filenames
+
     def __getitem__(self, index):
         # Import the image.
         img = self.get_image(index)
 
         # Get the bounding box limits and class of objects in the image
         objects_properties = self.get_gt(index)
+        return self.pull_item(img, objects_properties)
 
+    def pull_item(self, img, objects_properties):
         # Transform the objects objects_properties to numpy arrays
         objects_properties = np.array(objects_properties, dtype=float)
 
@@ -75,22 +90,12 @@ class TreeDataset(data.Dataset):
 
     def get_gt(self, index):
         # Get the ground truth objects in image.
-        filename = self.filenames[index]
-        filepath = osp.join(self.objects_dir, filename + '.csv')
-        objects_properties = list()
-        if os.path.exists(filepath):
-            with open(filepath, newline='') as csvfile:
-                csv_content = csv.reader(csvfile, delimiter=',')
-                # Skip header.
-                next(csv_content, None)
-                for row in csv_content:
-                    objects_properties.append([int(x) for x in row])
-
-        # Make sure that object properties has the expected number of columns, even if empty.
-        output = np.array(objects_properties, dtype=float)
-        if output.ndim == 1:
-            output = output.reshape(-1, len(self.object_properties_name))
-        return output
+        return self.annotations[index]
+
+    def load_annotations(self):
+        filepaths = [osp.join(self.objects_dir, filename + '.csv') for filename in self.filenames]
+        return AnnotationIndex.load(osp.join(self.root, ANNOTATION_INDEX_FILENAME), filepaths,
+                                    len(self.object_properties_name))
 
     def get_image(self, index):
         '''Returns the original image object at index in PIL form
@@ -103,9 +108,34 @@ class TreeDataset(data.Dataset):
         Return:
             PIL img
         '''
+        if self.image_cache is not None:
+            return self.image_cache[index]
+        return self.read_image(index)
+
+    def read_image(self, index):
+        # Decode the image from its source file.
+        return cv2.imread(self.image_source(index))
+
+    def image_source(self, index):
         filename = self.filenames[index]
-        filepath = osp.join(self.images_dir, filename + '.jpg')
-        return cv2.imread(filepath)
+        return osp.join(self.images_dir, filename + '.jpg')
+
+    def read_image_bytes(self, index):
+        # Encoded bytes of the image file.
+        with open(self.image_source(index), 'rb') as file:
+            return file.read()
+
+    def use_image_cache(self, cache_dir):
+        '''Read the decoded images from a memory-mapped cache instead of decoding them for each sample.
+
+        Argument:
+            cache_dir (str): directory of the cache, preferably on a local disk.
+        '''
+        sources = [self.image_source(i) for i in range(len(self))]
+        # The source file may hold several images, as in the packed dataset.
+        keys = [source + ':' + filename for source, filename in zip(sources, self.filenames)]
+        self.image_cache = ImageCache(cache_dir)
+        self.image_cache.update(keys, sources, self.read_image)
 
     def object_transform(self, objects, input_properties_name):
         """
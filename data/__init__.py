@@ -1,4 +1,5 @@
 from .Tree import TreeDataset
+from .packed import PackedTreeDataset, pack_dataset
 from .config import get_passed_args, build_config, extra_configs
 import torch
 import cv2
@@ -26,6 +27,25 @@ def detection_collate(batch):
     return torch.stack(imgs, 0), targets
 
 
+def build_dataset(config, transform=None):
+    """Build the dataset object matching the dataset config.
+
+    Arguments:
+        config (object): dataset config object created from config.py
+        transform: transform applied to the images and bounding boxes
+    Return:
+        PackedTreeDataset if a packed directory is configured, TreeDataset otherwise. Decoded images are cached if a
+        cache directory is configured.
+    """
+    if config.packed_dir:
+        dataset = PackedTreeDataset(config, transform=transform)
+    else:
+        dataset = TreeDataset(config, transform=transform)
+    if config.image_cache_dir:
+        dataset.use_image_cache(config.image_cache_dir)
+    return dataset
+
+
 def base_transform(image, size, mean):
     x = cv2.resize(image, (size, size)).astype(np.float32)
     x -= mean
@@ -0,0 +1,92 @@
+import os
+import os.path as osp
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+# Number of threads reading the bounding boxes CSV files.
+NUM_READ_THREADS = 16
+
+
+def read_objects_csv(filepath, N_properties):
+    """
+    Read the objects properties of an image.
+    :param filepath: path of the bounding boxes CSV file. A missing file means that the image has no objects.
+    :param N_properties: number of columns of the CSV file.
+    :return: array of objects properties, Shape: [N_objects, N_properties]
+    """
+    if not os.path.exists(filepath):
+        return np.zeros((0, N_properties))
+    with open(filepath, newline='') as csvfile:
+        # Skip header.
+        rows = csvfile.read().splitlines()[1:]
+    return np.array([row.split(',') for row in rows if row], dtype=float).reshape(-1, N_properties)
+
+
+def file_signature(filepath):
+    # Modification time and size used to detect changes of a file. Missing files have a signature of (-1, -1).
+    try:
+        stat = os.stat(filepath)
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_mtime_ns, stat.st_size
+
+
+class AnnotationIndex(object):
+    """Ground truth objects of all images of a dataset stored in one contiguous array.
+
+    The objects of image i are objects[offsets[i]:offsets[i + 1]]. The index is saved in a .npz sidecar file along
+    with the signature (modification time, size) of every CSV file and is rebuilt if any CSV file changed.
+
+    Arguments:
+        objects (np.array): objects properties of all images, Shape: [N_objects, N_properties]
+        offsets (np.array): start of the objects of each image, Shape: [N_images + 1]
+    """
+
+    def __init__(self, objects, offsets):
+        self.objects = objects
+        self.objects.setflags(write=False)
+        self.offsets = offsets
+
+    def __getitem__(self, index):
+        return self.objects[self.offsets[index]:self.offsets[index + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @classmethod
+    def build(cls, filepaths, N_properties):
+        # Read all CSV files in parallel, since reading is dominated by the file system latency.
+        with ThreadPoolExecutor(NUM_READ_THREADS) as executor:
+            objects = list(executor.map(lambda path: read_objects_csv(path, N_properties), filepaths))
+        offsets = np.zeros(len(filepaths) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in objects])
+        objects = np.concatenate(objects, 0) if objects else np.zeros((0, N_properties))
+        return cls(objects, offsets)
+
+    @classmethod
+    def load(cls, index_path, filepaths, N_properties):
+        """
+        Load the annotation index from its sidecar file, or rebuild it if it is missing or stale.
+        :param index_path: path of the .npz sidecar file.
+        :param filepaths: path of the bounding boxes CSV file of each image.
+        :param N_properties: number of columns of the CSV files.
+        :return: AnnotationIndex
+        """
+        signatures = np.array([file_signature(path) for path in filepaths], dtype=np.int64).reshape(-1, 2)
+        if osp.isfile(index_path):
+            with np.load(index_path) as sidecar:
+                if list(sidecar['filepaths']) == list(filepaths) and \
+                        np.array_equal(sidecar['signatures'], signatures):
+                    return cls(sidecar['objects'], sidecar['offsets'])
+
+        index = cls.build(filepaths, N_properties)
+        try:
+            # Write to a temporary file first, so that concurrent readers never load a partially written sidecar.
+            tmp_path = index_path + '.tmp.npz'
+            np.savez(tmp_path, objects=index.objects, offsets=index.offsets, filepaths=np.array(filepaths, dtype=str),
+                     signatures=signatures)
+            os.replace(tmp_path, index_path)
+        except OSError as error:
+            print('WARNING: The annotation index could not be saved in {}: {}'.format(index_path, error))
+        return index
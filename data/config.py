@@ -6,6 +6,7 @@ import re
 from argparse import ArgumentParser
 from collections import OrderedDict
 from utils.augmentations import SSDAugmentation, TreeAugmentation
+from utils.batch_augmentations import BatchTreeAugmentation
 
 # Get project and dataset directories across platform
 from .host_config import get_host_config, CONFIGS_DIR
@@ -16,7 +17,7 @@ ROOT_DIR = HOST_CONFIG['root']
 # Inspired from:
 # https://github.com/ltrottier/pytorch-object-recognition/blob/master/opts.py
 # Original author: Ludovic Trottier
-parser = ArgumentParser()
+parser = ArgumentParser(allow_abbrev=False)
 
 # dataset
 parser.add_argument('--dataset_dir', type=str,
@@ -30,11 +31,18 @@ parser.add_argument('--dataset_classes_name', type=str, default=['branchpoints',
 parser.add_argument('--dataset_object_properties', type=str, default=['xmin', 'xmax', 'ymin', 'ymax', 'class'],
                     help='ordered object properties that appear in the ground truth and detection files.')
 parser.add_argument('--dataset_augmentation', type=str, default='SSDAugmentation',
-                    help='Type of augmentation scheme used when loading images.')
+                    help='Type of augmentation scheme used when loading images. BatchTreeAugmentation augments '
+                         'whole batches after collation instead of single images in the dataloader workers.')
 parser.add_argument('--dataset_images_dir', type=str, default='images/',
                     help='Subdirectory of dataset_dir where images are saved')
 parser.add_argument('--dataset_bounding_boxes_dir', type=str, default='bounding_boxes/',
                     help='Subdirectory of dataset_dir where bounding boxes properties are saved')
+parser.add_argument('--dataset_packed_dir', type=str,
+                    help='Subdirectory of dataset_dir where the packed dataset is saved. '
+                         'If not set, the images and bounding boxes subdirectories are read.')
+parser.add_argument('--dataset_image_cache_dir', type=str,
+                    help='Directory, preferably on a local disk, where decoded images are cached. '
+                         'Relative paths are subdirectories of the host root directory. Disabled if not set.')
 
 # dataloader
 parser.add_argument('--dataloader_batch_size', type=int, default=4,
@@ -65,35 +73,62 @@ parser.add_argument('--train_weight_decay', type=float, default=5e-4,
                     help='Weigth decay for SGD')
 parser.add_argument('--train_visdom', default=False, type=bool,
                     help='Use visdom to visualize')
+parser.add_argument('--train_distributed', default=False, type=bool,
+                    help='Train with one CPU process per NUMA node using torch.distributed (gloo backend)')
+parser.add_argument('--train_dist_url', type=str, default='tcp://127.0.0.1:23456',
+                    help='Address of the rank 0 process used to initialize the distributed processes')
+parser.add_argument('--train_dist_num_nodes', type=int, default=1,
+                    help='Number of machines taking part in distributed training')
+parser.add_argument('--train_dist_node_rank', type=int, default=0,
+                    help='Rank of this machine in distributed training. The machine of rank 0 saves the checkpoints.')
+parser.add_argument('--train_dist_procs_per_node', type=int,
+                    help='Number of training processes per machine. Defaults to the number of NUMA nodes.')
+parser.add_argument('--train_precision', default='fp32', type=str,
+                    help="Precision of the network forward and backward passes: 'fp32', 'bf16' or 'fp16'. The "
+                         "reduced precisions use autocast")
 
 # model
 parser.add_argument('--model_basenet', type=str, default='vgg16_reducedfc.pth',
-                    help='Pretrained base model')
+                    help="Base network: 'vgg16' or 'mobilenet' to train it from scratch, or the filename of its "
+                         "pretrained weights in --output_weights_dir, starting with the base network name.")
 parser.add_argument('--model_num_classes', type=str, default=parser.get_default("dataset_num_classes") + 1,
                     help='Number of classes that the model distinguishes. Background class adds 1.')
 parser.add_argument('--model_pixel_means', type=int, default=[129, 129, 129],
                     help='Mean value of pixels. Subtracted before processing')
-parser.add_argument('--model_feature_maps_dim', type=int, default=[38, 19, 10, 5, 3, 1],
-                    help='Square dimension of feature maps.')
+parser.add_argument('--model_feature_maps_dim', type=int, default=None,
+                    help='Square dimension of feature maps. Inferred from --model_input_size if null. When given, it '
+                         'is checked against the inferred dimensions.')
 parser.add_argument('--model_input_size', type=int, default=300,
-                    help='Square size of network input image')
+                    help='Square size of network input image. Any size from 268 is supported; the feature maps and the '
+                         'number of priors grow with the input size.')
 parser.add_argument('--model_prior_box_scales', type=float,
                     default=[0.1, 0.2, 0.37, 0.54, 0.71, 0.88, 1.05],
-                    help='Size of prior boxes relative to --model_input_size')
+                    help='Size of prior boxes relative to --model_input_size, for each feature map and one more '
+                         'for the last feature map')
 parser.add_argument('--model_prior_box_aspect_ratios', type=float,
                     default=[[1 / 2, 2], [1 / 2, 2, 1 / 3, 3], [1 / 2, 2, 1 / 3, 3], [1 / 2, 2, 1 / 3, 3],
                              [1 / 2, 2], [1 / 2, 2]],
-                    help='Aspect ratios of prior boxes in each feature map')
+                    help='Aspect ratios of prior boxes in each feature map. Each feature map location has 2 priors '
+                         'of aspect ratio 1 and one prior per aspect ratio.')
 parser.add_argument('--model_prior_box_clip', type=bool,
                     default=True,
                     help='Clip the prior box dimensions to fit the image.')
 parser.add_argument('--model_prior_box_variance', type=float, default=[0.1, 0.2],
                     help='Variance used to encore/decode bounding boxes')
+parser.add_argument('--model_nms_engine', type=str, default='batched',
+                    help="Non-maximum suppression engine of the detection layer: 'batched' or 'matrix'")
+parser.add_argument('--model_build_mode', type=str, default='default',
+                    help="'optimized' keeps the activations in channels_last memory format and fuses the "
+                         "convolutions with their ReLU in TorchScript exports on the CPU. The weights are "
+                         "compatible with the 'default' build.")
 
 # eval
 parser.add_argument('--eval_model_name',
                     default='ssd300_' + parser.get_default("dataset_name") + '_Final.pth', type=str,
                     help='trained model filename in --output_weights_dir used for evaluation')
+parser.add_argument('--eval_model_format', default='state_dict', type=str,
+                    help="Format of --eval_model_name: 'state_dict' of the network or 'torchscript' module exported "
+                         "with export.py")
 parser.add_argument('--eval_overwrite_all_detections', default=False, type=bool,
                     help='Overwrite all_detections file')
 parser.add_argument('--eval_confidence_threshold', default=0.01, type=float,
@@ -102,9 +137,32 @@ parser.add_argument('--eval_top_k', default=50, type=int,
                     help='Restrict the number of predictions per image')
 parser.add_argument('--eval_cuda', default=True, type=bool,
                     help='Use CUDA to evaluate the model')
+parser.add_argument('--eval_tiled', default=False, type=bool,
+                    help='Slide the network input window over full-size images instead of resizing them')
+parser.add_argument('--eval_tile_overlap', default=50, type=int,
+                    help='Minimum overlap in pixels between neighbouring tiles when --eval_tiled is set')
+parser.add_argument('--eval_batch_size', default=8, type=int,
+                    help='Number of images (or tiles when --eval_tiled is set) per forward pass')
+parser.add_argument('--eval_num_workers', default=2, type=int,
+                    help='Number of workers decoding the images during evaluation')
+parser.add_argument('--eval_precision', default='fp32', type=str,
+                    help="Precision of the network forward pass: 'fp32', 'bf16' or 'fp16'. The reduced precisions use "
+                         "autocast")
+parser.add_argument('--eval_pr_curves', default=False, type=bool,
+                    help='Save the precision-recall curves and average precision of each class in the statistics')
+parser.add_argument('--eval_pr_iou_thresholds', default=[0.5, 0.75], type=float,
+                    help='Minimum jaccard overlaps of a true positive at which the precision-recall curves are computed')
+parser.add_argument('--eval_result_cache_dir', type=str,
+                    help='Directory where the detections of each image are cached, keyed by the image content, model '
+                         'weights and configuration. Relative paths are subdirectories of the host root directory. '
+                         'Disabled if not set.')
+parser.add_argument('--eval_result_cache_size', default=1024, type=int,
+                    help='Maximum size in MB of the detections cache. The least recently used results are removed.')
 
 # criterion
 parser.add_argument('--criterion_train', type=str, default='multibox')
+parser.add_argument('--criterion_hard_negative_mining', type=str, default='topk',
+                    help="Selection of the hardest negatives: 'topk' selection or full 'sort' of the priors")
 
 # output
 parser.add_argument('--output_weights_dir', type=str, default='weights/',
@@ -184,7 +242,7 @@ tree_synth2_config = {
 # Configuration class definitions
 class dataset:
     def __init__(self, dir, name, num_classes, classes_name, images_dir, object_properties, augmentation,
-                 bounding_boxes_dir):
+                 bounding_boxes_dir, packed_dir, image_cache_dir):
         self.dir = dir
         self.name = name
         self.num_classes = num_classes
@@ -193,6 +251,8 @@ class dataset:
         self.object_properties = object_properties
         self.augmentation = augmentation
         self.bounding_boxes_dir = bounding_boxes_dir
+        self.packed_dir = packed_dir
+        self.image_cache_dir = image_cache_dir
 
 
 class dataloader:
@@ -203,7 +263,8 @@ class dataloader:
 
 class train:
     def __init__(self, cuda, num_epochs, start_epoch, resume, resume_weights_only,
-                 lr_init, lr_schedule, lr_decay, momentum, weight_decay, visdom):
+                 lr_init, lr_schedule, lr_decay, momentum, weight_decay, visdom, distributed, dist_url,
+                 dist_num_nodes, dist_node_rank, dist_procs_per_node, precision):
         self.cuda = cuda
         self.num_epochs = num_epochs
         self.start_epoch = start_epoch
@@ -215,11 +276,18 @@ class train:
         self.momentum = momentum
         self.weight_decay = weight_decay
         self.visdom = visdom
+        self.distributed = distributed
+        self.dist_url = dist_url
+        self.dist_num_nodes = dist_num_nodes
+        self.dist_node_rank = dist_node_rank
+        self.dist_procs_per_node = dist_procs_per_node
+        self.precision = precision
 
 
 class model:
     def __init__(self, basenet, num_classes, pixel_means, feature_maps_dim, input_size,
-                 prior_box_scales, prior_box_aspect_ratios, prior_box_clip, prior_box_variance):
+                 prior_box_scales, prior_box_aspect_ratios, prior_box_clip, prior_box_variance, nms_engine,
+                 build_mode):
         self.basenet = basenet
         self.num_classes = num_classes
         self.pixel_means = pixel_means
@@ -229,20 +297,35 @@ class model:
         self.prior_box_aspect_ratios = prior_box_aspect_ratios
         self.prior_box_clip = prior_box_clip
         self.prior_box_variance = prior_box_variance
+        self.nms_engine = nms_engine
+        self.build_mode = build_mode
 
 
 class eval:
-    def __init__(self, model_name, overwrite_all_detections, confidence_threshold, top_k, cuda):
+    def __init__(self, model_name, model_format, overwrite_all_detections, confidence_threshold, top_k, cuda,
+                 tiled, tile_overlap, batch_size, num_workers, precision, pr_curves, pr_iou_thresholds,
+                 result_cache_dir, result_cache_size):
         self.model_name = model_name
+        self.model_format = model_format
         self.overwrite_all_detections = overwrite_all_detections
         self.confidence_threshold = confidence_threshold
         self.top_k = top_k
         self.cuda = cuda
+        self.tiled = tiled
+        self.tile_overlap = tile_overlap
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.precision = precision
+        self.pr_curves = pr_curves
+        self.pr_iou_thresholds = pr_iou_thresholds
+        self.result_cache_dir = result_cache_dir
+        self.result_cache_size = result_cache_size
 
 
 class criterion:
-    def __init__(self, train):
+    def __init__(self, train, hard_negative_mining):
         self.train = train
+        self.hard_negative_mining = hard_negative_mining
 
 
 class output:
@@ -265,6 +348,10 @@ class configs:
         self.dataset.dir = os.path.join(ROOT_DIR, self.dataset.dir)
         self.dataset.bounding_boxes_dir = os.path.join(self.dataset.dir, self.dataset.bounding_boxes_dir)
         self.dataset.images_dir = os.path.join(self.dataset.dir, self.dataset.images_dir)
+        if self.dataset.packed_dir:
+            self.dataset.packed_dir = os.path.join(self.dataset.dir, self.dataset.packed_dir)
+        if self.dataset.image_cache_dir:
+            self.dataset.image_cache_dir = os.path.join(ROOT_DIR, self.dataset.image_cache_dir)
 
         self.output.weights_dir = os.path.join(ROOT_DIR, self.output.weights_dir)
         self.output.detections_dir = os.path.join(self.dataset.dir, self.output.detections_dir)
@@ -273,6 +360,8 @@ class configs:
         if self.train.resume:
             self.train.resume = os.path.join(self.output.weights_dir, self.train.resume)
         self.eval.model_name = os.path.join(self.output.weights_dir, self.eval.model_name)
+        if self.eval.result_cache_dir:
+            self.eval.result_cache_dir = os.path.join(ROOT_DIR, self.eval.result_cache_dir)
 
     def get_config_names(self):
         conf_categories = list(vars(self).keys())
@@ -315,8 +404,10 @@ def create_config_obj(config_dict):
     object_properties = dataset_dict['object_properties']
     augmentation = dataset_dict['augmentation']
     bounding_boxes_dir = dataset_dict['bounding_boxes_dir']
+    packed_dir = dataset_dict['packed_dir']
+    image_cache_dir = dataset_dict['image_cache_dir']
     dataset_conf = dataset(dir, name, num_classes, classes_name, images_dir, object_properties, augmentation,
-                           bounding_boxes_dir)
+                           bounding_boxes_dir, packed_dir, image_cache_dir)
 
     dataloader_dict = config_dict['dataloader']
     batch_size = dataloader_dict['batch_size']
@@ -335,8 +426,15 @@ def create_config_obj(config_dict):
     momentum = train_dict['momentum']
     weight_decay = train_dict['weight_decay']
     visdom = train_dict['visdom']
+    distributed = train_dict['distributed']
+    dist_url = train_dict['dist_url']
+    dist_num_nodes = train_dict['dist_num_nodes']
+    dist_node_rank = train_dict['dist_node_rank']
+    dist_procs_per_node = train_dict['dist_procs_per_node']
+    precision = train_dict['precision']
     train_conf = train(cuda, num_epochs, start_epoch, resume, resume_weights_only,
-                       lr_init, lr_schedule, lr_decay, momentum, weight_decay, visdom)
+                       lr_init, lr_schedule, lr_decay, momentum, weight_decay, visdom, distributed, dist_url,
+                       dist_num_nodes, dist_node_rank, dist_procs_per_node, precision)
 
     model_dict = config_dict['model']
     basenet = model_dict['basenet']
@@ -348,19 +446,33 @@ def create_config_obj(config_dict):
     prior_box_aspect_ratios = model_dict['prior_box_aspect_ratios']
     prior_box_clip = model_dict['prior_box_clip']
     prior_box_variance = model_dict['prior_box_variance']
+    nms_engine = model_dict['nms_engine']
+    build_mode = model_dict['build_mode']
     model_conf = model(basenet, num_classes, pixel_means, feature_maps_dim, input_size, prior_box_scales,
-                       prior_box_aspect_ratios, prior_box_clip, prior_box_variance)
+                       prior_box_aspect_ratios, prior_box_clip, prior_box_variance, nms_engine, build_mode)
 
     eval_dict = config_dict['eval']
     model_name = eval_dict['model_name']
+    model_format = eval_dict['model_format']
     overwrite_all_detections = eval_dict['overwrite_all_detections']
     confidence_threshold = eval_dict['confidence_threshold']
     top_k = eval_dict['top_k']
     cuda = eval_dict['cuda']
-    eval_conf = eval(model_name, overwrite_all_detections, confidence_threshold, top_k, cuda)
+    tiled = eval_dict['tiled']
+    tile_overlap = eval_dict['tile_overlap']
+    batch_size = eval_dict['batch_size']
+    num_workers = eval_dict['num_workers']
+    precision = eval_dict['precision']
+    pr_curves = eval_dict['pr_curves']
+    pr_iou_thresholds = eval_dict['pr_iou_thresholds']
+    result_cache_dir = eval_dict['result_cache_dir']
+    result_cache_size = eval_dict['result_cache_size']
+    eval_conf = eval(model_name, model_format, overwrite_all_detections, confidence_threshold, top_k, cuda, tiled,
+                     tile_overlap, batch_size, num_workers, precision, pr_curves, pr_iou_thresholds, result_cache_dir,
+                     result_cache_size)
 
     criterion_dict = config_dict['criterion']
-    criterion_conf = criterion(criterion_dict['train'])
+    criterion_conf = criterion(criterion_dict['train'], criterion_dict['hard_negative_mining'])
 
     output_dict = config_dict['output']
     weights_dir = output_dict['weights_dir']
@@ -387,6 +499,9 @@ def create_config_obj(config_dict):
         configs_obj.dataset.augmentation = SSDAugmentation(configs_obj.model.input_size, configs_obj.model.pixel_means)
     elif configs_obj.dataset.augmentation == 'TreeAugmentation':
         configs_obj.dataset.augmentation = TreeAugmentation(configs_obj.model.input_size, configs_obj.model.pixel_means)
+    elif configs_obj.dataset.augmentation == 'BatchTreeAugmentation':
+        configs_obj.dataset.augmentation = BatchTreeAugmentation(configs_obj.model.input_size,
+                                                                 configs_obj.model.pixel_means)
     else:
         raise NotImplemented('The augmentation scheme {} is not implemented'.format(configs_obj.dataset.augmentation))
 
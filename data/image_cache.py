@@ -0,0 +1,95 @@
+import os
+import os.path as osp
+
+import numpy as np
+
+INDEX_FILENAME = 'index.npz'
+DATA_FILENAME = 'images.bin'
+
+
+class ImageCache(object):
+    """Cache of decoded images stored in a uint8 memory-mapped file on local disk.
+
+    Images are decoded once and appended to the data file. The index file records the offset and shape of each
+    image, as well as the modification time and size of its source file. An entry is decoded again when its source
+    file changes. The data file is opened read-only and lazily by each process, so that DataLoader workers share the
+    page cache without copying the images. Images of stale entries are not removed from the data file; delete the
+    cache directory to reclaim the space.
+
+    Arguments:
+        cache_dir (str): directory where the cache files are saved.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.index_path = osp.join(cache_dir, INDEX_FILENAME)
+        self.data_path = osp.join(cache_dir, DATA_FILENAME)
+        self.entries = {}
+        self.rows = []
+        self.data = None
+        if not osp.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.load_index()
+
+    def load_index(self):
+        if not osp.isfile(self.index_path) or not osp.isfile(self.data_path):
+            return
+        index = np.load(self.index_path)
+        for key, offset, shape, mtime, size in zip(index['keys'], index['offsets'], index['shapes'], index['mtimes'],
+                                                   index['sizes']):
+            self.entries[str(key)] = (int(offset), tuple(int(x) for x in shape), int(mtime), int(size))
+
+    def save_index(self):
+        keys = list(self.entries.keys())
+        entries = [self.entries[key] for key in keys]
+        tmp_path = self.index_path + '.tmp.npz'
+        np.savez(tmp_path, keys=np.array(keys, dtype=str),
+                 offsets=np.array([e[0] for e in entries], dtype=np.int64).reshape(-1),
+                 shapes=np.array([e[1] for e in entries], dtype=np.int64).reshape(-1, 3),
+                 mtimes=np.array([e[2] for e in entries], dtype=np.int64).reshape(-1),
+                 sizes=np.array([e[3] for e in entries], dtype=np.int64).reshape(-1))
+        os.replace(tmp_path, self.index_path)
+
+    def update(self, keys, source_paths, read_image):
+        """
+        Decode the images that are missing from the cache or whose source file changed.
+        :param keys: unique key of each image.
+        :param source_paths: path of the file each image is read from.
+        :param read_image: function returning the decoded image at an index of keys.
+        :return: None
+        """
+        stale = []
+        for i, (key, path) in enumerate(zip(keys, source_paths)):
+            stat = os.stat(path)
+            entry = self.entries.get(key)
+            if entry is None or entry[2:] != (stat.st_mtime_ns, stat.st_size):
+                stale.append((i, stat))
+
+        if stale:
+            print('Caching {:d} decoded images in {}'.format(len(stale), self.cache_dir))
+            self.data = None
+            with open(self.data_path, 'ab') as data_file:
+                for i, stat in stale:
+                    image = np.ascontiguousarray(read_image(i), dtype=np.uint8)
+                    if image.ndim == 2:
+                        image = image[:, :, np.newaxis]
+                    offset = data_file.tell()
+                    data_file.write(image.tobytes())
+                    self.entries[keys[i]] = (offset, image.shape, stat.st_mtime_ns, stat.st_size)
+            self.save_index()
+        self.rows = [self.entries[key] for key in keys]
+
+    def __getitem__(self, index):
+        if self.data is None:
+            self.data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        offset, shape, _, _ = self.rows[index]
+        return self.data[offset:offset + int(np.prod(shape))].reshape(shape)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getstate__(self):
+        # Each process maps the data file itself instead of receiving a copy of the images.
+        state = self.__dict__.copy()
+        state['data'] = None
+        return state
@@ -0,0 +1,149 @@
+import os
+import os.path as osp
+import argparse
+
+import cv2
+import numpy as np
+from .Tree import TreeDataset
+from .annotations import AnnotationIndex
+from .config import dataset
+
+INDEX_FILENAME = 'index.npz'
+SHARD_FILENAME = 'shard_{:03d}.bin'
+
+
+class PackedTreeDataset(TreeDataset):
+    """Tree Detection Dataset Object read from packed shard files.
+
+    Each sample is stored as a contiguous record made of the encoded JPEG image followed by the ground truth objects
+    (int32, in the column order of the dataset object properties). The index file gives the shard, offset and size of
+    each record. The objects of all records are read once when the dataset is opened, so that a sample only reads its
+    image with a single seek.
+
+    Arguments:
+        config (object): dataset config object created from config.py
+    """
+
+    def __init__(self, config: dataset, transform=None):
+        self.packed_dir = config.packed_dir
+        index = np.load(osp.join(self.packed_dir, INDEX_FILENAME))
+        self.index_filenames = [str(filename) for filename in index['filenames']]
+        self.shards = index['shards']
+        self.offsets = index['offsets']
+        self.image_sizes = index['image_sizes']
+        self.N_objects = index['N_objects']
+        if list(index['object_properties']) != list(config.object_properties):
+            raise Exception('The packed object properties {} do not match the dataset object properties {}.'.format(
+                list(index['object_properties']), config.object_properties))
+
+        # Shard files are opened lazily by each process, since DataLoader workers cannot share file positions.
+        self.files = {}
+        self.files_pid = None
+
+        super(PackedTreeDataset, self).__init__(config, transform)
+
+    def find_filenames(self):
+        return list(self.index_filenames)
+
+    def shard_file(self, shard):
+        if self.files_pid != os.getpid():
+            self.files = {}
+            self.files_pid = os.getpid()
+        if shard not in self.files:
+            self.files[shard] = open(osp.join(self.packed_dir, SHARD_FILENAME.format(shard)), 'rb')
+        return self.files[shard]
+
+    def load_annotations(self):
+        # Read the ground truth objects of all records once, seeking past the encoded images.
+        index_rows = {filename: row for row, filename in enumerate(self.index_filenames)}
+        self.rows = [index_rows[filename] for filename in self.filenames]
+        N_properties = len(self.object_properties_name)
+        objects = []
+        for row in self.rows:
+            file = self.shard_file(int(self.shards[row]))
+            file.seek(int(self.offsets[row] + self.image_sizes[row]))
+            objects.append(np.frombuffer(file.read(int(self.N_objects[row]) * N_properties * 4), dtype=np.int32))
+        offsets = np.zeros(len(self.rows) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(self.N_objects[self.rows])
+        objects = np.concatenate(objects) if objects else np.zeros(0, dtype=np.int32)
+        return AnnotationIndex(objects.reshape(-1, N_properties).astype(float), offsets)
+
+    def read_image(self, index):
+        image_bytes = self.read_image_bytes(index)
+        return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    def image_source(self, index):
+        return osp.join(self.packed_dir, SHARD_FILENAME.format(int(self.shards[self.rows[index]])))
+
+    def read_image_bytes(self, index):
+        row = self.rows[index]
+        file = self.shard_file(int(self.shards[row]))
+        file.seek(int(self.offsets[row]))
+        return file.read(int(self.image_sizes[row]))
+
+    def __getstate__(self):
+        # Open files are not picklable. They are reopened by the worker processes.
+        state = self.__dict__.copy()
+        state['files'] = {}
+        state['files_pid'] = None
+        return state
+
+
+def pack_dataset(tree_dataset: TreeDataset, output_dir, shard_size=1 << 30):
+    """
+    Pack the images and ground truths of a dataset into shard files.
+    :param tree_dataset: dataset read from the images and bounding boxes folders.
+    :param output_dir: directory where the shards and index are saved.
+    :param shard_size: maximum size of a shard file in bytes.
+    :return: None
+    """
+    if not osp.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    N_images = len(tree_dataset)
+    shards = np.zeros(N_images, dtype=np.int32)
+    offsets = np.zeros(N_images, dtype=np.int64)
+    image_sizes = np.zeros(N_images, dtype=np.int64)
+    N_objects = np.zeros(N_images, dtype=np.int32)
+
+    shard = 0
+    shard_file = open(osp.join(output_dir, SHARD_FILENAME.format(shard)), 'wb')
+    for i, filename in enumerate(tree_dataset.filenames):
+        # Store the encoded JPEG as is to keep the shards small.
+        with open(osp.join(tree_dataset.images_dir, filename + '.jpg'), 'rb') as image_file:
+            image_bytes = image_file.read()
+        objects_bytes = tree_dataset.get_gt(i).astype(np.int32).tobytes()
+
+        if shard_file.tell() > 0 and shard_file.tell() + len(image_bytes) + len(objects_bytes) > shard_size:
+            shard_file.close()
+            shard += 1
+            shard_file = open(osp.join(output_dir, SHARD_FILENAME.format(shard)), 'wb')
+
+        shards[i] = shard
+        offsets[i] = shard_file.tell()
+        image_sizes[i] = len(image_bytes)
+        N_objects[i] = len(objects_bytes) // (4 * len(tree_dataset.object_properties_name))
+        shard_file.write(image_bytes)
+        shard_file.write(objects_bytes)
+    shard_file.close()
+
+    np.savez(osp.join(output_dir, INDEX_FILENAME), filenames=np.array(tree_dataset.filenames), shards=shards,
+             offsets=offsets, image_sizes=image_sizes, N_objects=N_objects,
+             object_properties=np.array(tree_dataset.object_properties_name))
+    print('Packed {:d} images in {:d} shard(s) in {}'.format(N_images, shard + 1, output_dir))
+
+
+if __name__ == '__main__':
+    from .config import build_config
+
+    parser = argparse.ArgumentParser(description='Pack a Tree dataset into shard files.')
+    parser.add_argument('--config', type=str,
+                        help='Name of configuration file. The shards are saved in dataset_packed_dir.')
+    parser.add_argument('--shard_size', default=1024, type=int,
+                        help='Maximum size of a shard file in MB')
+    args = parser.parse_args()
+
+    configs = build_config(args.config)
+    if not configs.dataset.packed_dir:
+        raise Exception('dataset_packed_dir is not set in {}.'.format(args.config))
+    pack_dataset(TreeDataset(configs.dataset), configs.dataset.packed_dir, args.shard_size << 20)
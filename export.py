@@ -0,0 +1,37 @@
+"""Export a trained network to TorchScript or ONNX.
+
+    The TorchScript module includes the detection layer and is evaluated without the source code of the network by
+    setting eval_model_format to 'torchscript'. The ONNX graph holds the base, extra and multibox layers.
+"""
+import argparse
+import os
+
+from data.config import build_config
+from utils.export import export_torchscript, export_onnx
+from utils.inference import load_network
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector Export')
+parser.add_argument('--config', type=str,
+                    help='Name of configuration file.')
+parser.add_argument('--format', default='torchscript', type=str,
+                    help="Export format: 'torchscript' or 'onnx'")
+parser.add_argument('--output', default=None, type=str,
+                    help='Path of the exported file. Defaults to eval_model_name with a .ts.pt or .onnx extension.')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    configs = build_config(args.config)
+    if args.format not in ('torchscript', 'onnx'):
+        raise ValueError("--format must be 'torchscript' or 'onnx'.")
+
+    # Load neural net.
+    net = load_network(configs, 'state_dict', cuda=False)
+
+    output = args.output or os.path.splitext(configs.eval.model_name)[0] + \
+        ('.ts.pt' if args.format == 'torchscript' else '.onnx')
+    if args.format == 'torchscript':
+        export_torchscript(net, output)
+    else:
+        export_onnx(net, output)
+    print('Exported {} to {}'.format(configs.eval.model_name, output))
@@ -27,45 +27,42 @@ def center_size(boxes_limits):
 
 
 def intersect(box_a, box_b):
-    """ We resize both tensors to [A,B,2] without new malloc:
-    [A,2] -> [A,1,2] -> [A,B,2]
-    [B,2] -> [1,B,2] -> [A,B,2]
+    """ We resize both tensors to [...,A,B,2] without new malloc:
+    [...,A,2] -> [...,A,1,2] -> [...,A,B,2]
+    [...,B,2] -> [...,1,B,2] -> [...,A,B,2]
     Then we compute the area of intersect between box_a and box_b.
     Args:
-      box_a: (tensor) bounding boxes, Shape: [A,4].
-      box_b: (tensor) bounding boxes, Shape: [B,4].
+      box_a: (tensor) bounding boxes, Shape: [...,A,4].
+      box_b: (tensor) bounding boxes, Shape: [...,B,4].
     Return:
-      (tensor) intersection area, Shape: [A,B].
+      (tensor) intersection area, Shape: [...,A,B].
     """
-    A = box_a.size(0)
-    B = box_b.size(0)
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(A, B, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(A, B, 2),
-                       box_b[:, :2].unsqueeze(0).expand(A, B, 2))
+    max_xy = torch.min(box_a[..., :, None, 2:], box_b[..., None, :, 2:])
+    min_xy = torch.max(box_a[..., :, None, :2], box_b[..., None, :, :2])
     inter = torch.clamp((max_xy - min_xy), min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    return inter[..., 0] * inter[..., 1]
 
 
 def jaccard(box_a, box_b):
     """Compute the jaccard overlap of two sets of boxes.  The jaccard overlap
     is simply the intersection over union of two boxes.  Here we operate on
-    ground truth boxes and default boxes.
+    ground truth boxes and default boxes. Leading batch dimensions are
+    broadcast.
     E.g.:
         A ∩ B / A ∪ B = A ∩ B / (area(A) + area(B) - A ∩ B)
     Args:
-        box_a: (tensor) Ground truth bounding boxes, Shape: [num_objects,4]
-        box_b: (tensor) Prior boxes from priorbox layers, Shape: [num_priors,4]
+        box_a: (tensor) Ground truth bounding boxes, Shape: [...,num_objects,4]
+        box_b: (tensor) Prior boxes from priorbox layers, Shape: [...,num_priors,4]
     Return:
-        jaccard overlap: (tensor) Shape: [box_a.size(0), box_b.size(0)]
+        jaccard overlap: (tensor) Shape: [...,box_a.size(-2), box_b.size(-2)]
     """
     inter = intersect(box_a, box_b)
-    area_a = ((box_a[:, 2]-box_a[:, 0]) *
-              (box_a[:, 3]-box_a[:, 1])).unsqueeze(1).expand_as(inter)  # [A,B]
-    area_b = ((box_b[:, 2]-box_b[:, 0]) *
-              (box_b[:, 3]-box_b[:, 1])).unsqueeze(0).expand_as(inter)  # [A,B]
+    area_a = ((box_a[..., 2]-box_a[..., 0]) *
+              (box_a[..., 3]-box_a[..., 1])).unsqueeze(-1)  # [...,A,1]
+    area_b = ((box_b[..., 2]-box_b[..., 0]) *
+              (box_b[..., 3]-box_b[..., 1])).unsqueeze(-2)  # [...,1,B]
     union = area_a + area_b - inter
-    return inter / union  # [A,B]
+    return inter / union  # [...,A,B]
 
 
 def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
@@ -112,49 +109,93 @@ def match(threshold, truths, priors, variances, labels, loc_t, conf_t, idx):
     conf_t[idx] = conf  # [num_priors] top class label for each prior
 
 
+def match_batch(threshold, truths, priors, variances, labels, valid, loc_t, conf_t):
+    """Match the priors of all images of a batch at once. Same as match, but the
+    ground truths of the batch are padded to the same number of objects and the
+    forced matches are resolved with tensor ops.
+    Args:
+        threshold: (float) The overlap threshold used when mathing boxes.
+        truths: (tensor) Padded ground truth boxes, Shape: [batch,num_obj,4].
+        priors: (tensor) Prior boxes from priorbox layers, Shape: [n_priors,4].
+        variances: (tensor) Variances corresponding to each prior coord,
+            Shape: [num_priors, 4].
+        labels: (tensor) Padded class labels, Shape: [batch,num_obj].
+        valid: (tensor) Mask of the ground truths that are not padding,
+            Shape: [batch,num_obj].
+        loc_t: (tensor) Tensor to be filled w/ endcoded location targets,
+            Shape: [batch,num_priors,4].
+        conf_t: (tensor) Tensor to be filled w/ matched indices for conf preds,
+            Shape: [batch,num_priors].
+    """
+    num, num_objects = labels.size()
+    # jaccard index, Shape: [batch,num_objects,num_priors]
+    overlaps = jaccard(truths, box_limits(priors))
+    overlaps.masked_fill_(~valid.unsqueeze(2), -1)  # padding never matches
+    # (Bipartite Matching)
+    # [batch,num_objects] best prior for each ground truth
+    best_prior_overlap, best_prior_idx = overlaps.max(2)
+    # [batch,num_priors] best ground truth for each prior
+    best_truth_overlap, best_truth_idx = overlaps.max(1)
+    # ensure every gt matches with its prior of max overlap. When several gts
+    # share a best prior, the last one wins as in match.
+    truth_ids = torch.arange(num_objects, device=labels.device).expand(num, -1)
+    truth_ids = truth_ids.masked_fill(~valid, -1)
+    forced_truth_idx = best_truth_idx.new_full(best_truth_idx.size(), -1)
+    forced_truth_idx.scatter_reduce_(1, best_prior_idx, truth_ids, 'amax')
+    forced = forced_truth_idx >= 0
+    best_truth_idx = torch.where(forced, forced_truth_idx, best_truth_idx)
+    best_truth_overlap.masked_fill_(forced, 2)  # ensure best prior
+    matches = truths.gather(1, best_truth_idx.unsqueeze(2).expand(-1, -1, 4))  # [batch,num_priors,4]
+    conf = labels.gather(1, best_truth_idx) + 1  # [batch,num_priors]
+    conf[best_truth_overlap < threshold] = 0  # label as background
+    loc_t.copy_(encode(matches, priors, variances))  # encoded offsets to learn
+    conf_t.copy_(conf)  # top class label for each prior
+
+
 def encode(matched, priors, variances):
     """Encode the variances from the priorbox layers into the ground truth boxes
     we have matched (based on jaccard overlap) with the prior boxes.
     Args:
         matched: (tensor) Coords of ground truth for each prior in point-form
-            Shape: [num_priors, 4].
+            Shape: [num_priors, 4] or [batch, num_priors, 4].
         priors: (tensor) Prior boxes in center-offset form
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
-        encoded boxes (tensor), Shape: [num_priors, 4]
+        encoded boxes (tensor), Shape: same as matched
     """
 
     # dist b/t match center and prior's center
-    g_cxcy = (matched[:, :2] + matched[:, 2:])/2 - priors[:, :2]
+    g_cxcy = (matched[..., :2] + matched[..., 2:])/2 - priors[..., :2]
     # encode variance
-    g_cxcy /= (variances[0] * priors[:, 2:])
+    g_cxcy /= (variances[0] * priors[..., 2:])
     # match wh / prior wh
-    g_wh = (matched[:, 2:] - matched[:, :2]) / priors[:, 2:]
+    g_wh = (matched[..., 2:] - matched[..., :2]) / priors[..., 2:]
     g_wh = torch.log(g_wh) / variances[1]
     # return target for smooth_l1_loss
-    return torch.cat([g_cxcy, g_wh], 1)  # [num_priors,4]
+    return torch.cat([g_cxcy, g_wh], -1)  # [...,num_priors,4]
 
 
 # Adapted from https://github.com/Hakuyume/chainer-ssd
 def decode(loc, priors, variances):
+    # type: (Tensor, Tensor, List[float]) -> Tensor
     """Decode locations from predictions using priors to undo
     the encoding we did for offset regression at train time.
     Args:
         loc (tensor): location predictions for loc layers,
-            Shape: [num_priors,4]
+            Shape: [num_priors,4] or [batch,num_priors,4]
         priors (tensor): Prior boxes in center-offset form.
             Shape: [num_priors,4].
         variances: (list[float]) Variances of priorboxes
     Return:
-        decoded bounding box predictions
+        decoded bounding box predictions, Shape: same as loc
     """
 
     boxes = torch.cat((
-        priors[:, :2] + loc[:, :2] * variances[0] * priors[:, 2:],
-        priors[:, 2:] * torch.exp(loc[:, 2:] * variances[1])), 1)
-    boxes[:, :2] -= boxes[:, 2:] / 2
-    boxes[:, 2:] += boxes[:, :2]
+        priors[..., :2] + loc[..., :2] * variances[0] * priors[..., 2:],
+        priors[..., 2:] * torch.exp(loc[..., 2:] * variances[1])), -1)
+    boxes[..., :2] -= boxes[..., 2:] / 2
+    boxes[..., 2:] += boxes[..., :2]
     return boxes
 
 
@@ -237,3 +278,34 @@ def nms(boxes, scores, overlap=0.5, top_k=200):
         # keep only elements with an IoU <= overlap
         idx = idx[IoU.le(overlap)]
     return keep, count
+
+
+def matrix_nms(boxes, candidates, overlap=0.5):
+    # type: (Tensor, Tensor, float) -> Tensor
+    """Apply non-maximum suppression to several groups of boxes at once using
+    the pairwise jaccard overlap matrix of each group. The suppression is
+    resolved with tensor ops and keeps the same boxes as the greedy nms.
+    Args:
+        boxes: (tensor) The candidate boxes of each group, sorted by
+            descending score, Shape: [num_groups,num_candidates,4].
+        candidates: (tensor) Mask of the valid candidates,
+            Shape: [num_groups,num_candidates].
+        overlap: (float) The overlap thresh for suppressing unnecessary boxes.
+    Return:
+        Mask of the kept candidates, Shape: [num_groups,num_candidates].
+    """
+    # suppress[g, i, j] is 1 when box i scores higher than box j and
+    # overlaps it above the threshold.
+    suppress = jaccard(boxes, boxes).gt(overlap).float().triu(1)
+
+    # A candidate is kept if no kept candidate of higher score suppresses it.
+    # Starting from all candidates, the first n entries of the mask are final
+    # after n iterations, so the fixed point is the greedy nms result.
+    keep = candidates
+    converged = False
+    while not converged:
+        suppressed = torch.bmm(keep.float().unsqueeze(1), suppress).squeeze(1)
+        new_keep = candidates & suppressed.eq(0)
+        converged = torch.equal(new_keep, keep)
+        keep = new_keep
+    return keep
@@ -1,16 +1,28 @@
 import torch
-from torch.autograd import Function
-from ..box_utils import decode, nms
+import torch.nn as nn
+from torchvision.ops import batched_nms
+from ..box_utils import decode, matrix_nms
 from data import extra_configs as dataset_config
 
 
-class Detect(Function):
+class Detect(nn.Module):
     """At test time, Detect is the final layer of SSD.  Decode location preds,
     apply non-maximum suppression to location predictions based on conf
     scores and threshold to a top_k number of output predictions for both
     confidence score and locations.
+
+    The nms engine is either 'batched', which runs torchvision's nms on all
+    candidates at once, or 'matrix', which resolves the suppression from the
+    jaccard overlap matrix of the candidates of each class (see matrix_nms).
+
+    The layer only uses TorchScript-compatible ops, so that it can be scripted
+    and exported with the network (see utils/export.py).
     """
-    def __init__(self, num_classes, bkg_label, top_k, conf_thresh, nms_thresh):
+    nms_engines = ('batched', 'matrix')
+
+    def __init__(self, num_classes, bkg_label, top_k, conf_thresh, nms_thresh,
+                 nms_engine='batched'):
+        super(Detect, self).__init__()
         self.num_classes = num_classes
         self.background_label = bkg_label
         self.top_k = top_k
@@ -19,7 +31,10 @@ class Detect(Function):
         if nms_thresh <= 0:
             raise ValueError('nms_threshold must be non negative.')
         self.conf_thresh = conf_thresh
-        self.variance = dataset_config['variance']
+        if nms_engine not in self.nms_engines:
+            raise ValueError('nms_engine must be one of {}.'.format(self.nms_engines))
+        self.nms_engine = nms_engine
+        self.variance = [float(v) for v in dataset_config['variance']]
 
     def forward(self, loc_data, conf_data, prior_data):
         """
@@ -33,31 +48,55 @@ class Detect(Function):
         """
         num = loc_data.size(0)  # batch size
         num_priors = prior_data.size(0)
-        output = torch.zeros(num, self.num_classes, self.top_k, 5)
+        num_groups = num * (self.num_classes - 1)
+        output = loc_data.new_zeros(num, self.num_classes, self.top_k, 5)
         conf_preds = conf_data.view(num, num_priors,
                                     self.num_classes).transpose(2, 1)
 
-        # Decode predictions into bboxes.
-        for i in range(num):
-            decoded_boxes = decode(loc_data[i], prior_data, self.variance)
-            # For each class, perform nms
-            conf_scores = conf_preds[i].clone()
-
-            for cl in range(1, self.num_classes):
-                c_mask = conf_scores[cl].gt(self.conf_thresh)
-                scores = conf_scores[cl][c_mask]
-                if scores.nelement() == 0:
-                # if scores.dim() == 0:
-                    continue
-                l_mask = c_mask.unsqueeze(1).expand_as(decoded_boxes)
-                boxes = decoded_boxes[l_mask].view(-1, 4)
-                # idx of highest scoring and non-overlapping boxes per class
-                ids, count = nms(boxes, scores, self.nms_thresh, self.top_k)
-                output[i, cl, :count] = \
-                    torch.cat((scores[ids[:count]].unsqueeze(1),
-                               boxes[ids[:count]]), 1)
-        flt = output.contiguous().view(num, -1, 5)
-        _, idx = flt[:, :, 0].sort(1, descending=True)
-        _, rank = idx.sort(1)
-        flt[(rank < self.top_k).unsqueeze(-1).expand_as(flt)].fill_(0)
+        # Decode predictions into bboxes for the whole batch at once.
+        decoded_boxes = decode(loc_data.view(num, num_priors, 4), prior_data,
+                               self.variance)
+
+        # Pre-select the top_k highest scoring boxes of every (image, class)
+        # pair, skipping the background class. Scores are sorted in
+        # descending order along the last dimension.
+        top_k = min(self.top_k, num_priors)
+        scores, idx = conf_preds[:, 1:].topk(top_k, dim=2)
+        boxes = decoded_boxes.gather(
+            1, idx.view(num, -1, 1).expand(-1, -1, 4))
+        scores = scores.contiguous().view(num_groups, top_k)
+        boxes = boxes.view(num_groups, top_k, 4)
+        candidates = scores.gt(self.conf_thresh)
+        if not candidates.any():
+            return output
+
+        if self.nms_engine == 'matrix':
+            # Candidates form a prefix of each group since scores are sorted.
+            num_candidates = int(candidates.sum(1).max())
+            keep_mask = torch.zeros_like(candidates)
+            keep_mask[:, :num_candidates] = matrix_nms(
+                boxes[:, :num_candidates], candidates[:, :num_candidates],
+                self.nms_thresh)
+        else:
+            # Run nms on all candidates in a single pass. Each (image, class)
+            # pair is a separate group so that boxes of different groups never
+            # suppress each other.
+            candidates_idx = candidates.view(-1).nonzero().squeeze(1)
+            groups = candidates_idx // top_k
+            keep = batched_nms(boxes.view(-1, 4)[candidates_idx],
+                               scores.view(-1)[candidates_idx],
+                               groups, self.nms_thresh)
+            keep_mask = torch.zeros_like(candidates)
+            keep_mask.view(-1)[candidates_idx[keep]] = True
+
+        # Candidates are sorted by score within each group, so the rank of a
+        # kept box in its group is the number of kept boxes preceding it.
+        rank = keep_mask.long().cumsum(1) - 1
+        group_idx, candidate_idx = keep_mask.nonzero().unbind(1)
+        detections = output.new_zeros(num_groups, self.top_k, 5)
+        detections[group_idx, rank[group_idx, candidate_idx]] = torch.cat(
+            (scores[group_idx, candidate_idx].unsqueeze(1),
+             boxes[group_idx, candidate_idx]), 1)
+        output[:, 1:] = detections.view(num, self.num_classes - 1,
+                                        self.top_k, 5)
         return output
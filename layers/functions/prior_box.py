@@ -1,21 +1,62 @@
 from __future__ import division
 from math import sqrt as sqrt
-from itertools import product as product
 from layers.box_utils import box_limits, center_size
 import torch
 
+# Prior box coordinates shared by all the networks of the process, keyed by
+# (input_size, feature_maps_dim, scales, aspect_ratios, clip).
+_coordinates_cache = {}
+
+
+def prior_box_coordinates(input_size, feature_maps_dim, scales, aspect_ratios, clip):
+    """Compute the prior box coordinates in center-offset form, Shape: [num_priors,4].
+
+    The priors of each feature map location are ordered as: the box of size s_k,
+    the box of size sqrt(s_k * s_(k+1)) and one box per aspect ratio. The
+    locations are ordered row by row. The tensor is cached and shared between
+    the calls with the same arguments, so it must not be modified in place.
+    """
+    key = (input_size, tuple(feature_maps_dim), tuple(scales),
+           tuple(tuple(ar) for ar in aspect_ratios), clip)
+    if key not in _coordinates_cache:
+        coordinates = []
+        for k, f in enumerate(feature_maps_dim):
+            # unit center x,y of each location, Shape: [f,f,1,2]
+            centers = (torch.arange(f, dtype=torch.float64) + 0.5) / f
+            cy, cx = torch.meshgrid(centers, centers, indexing='ij')
+            centers = torch.stack((cx, cy), -1).unsqueeze(2)
+
+            # rel sizes: min_size, sqrt(s_k * s_(k+1)) and rest of aspect
+            # ratios, Shape: [num_boxes,2]
+            s_k = scales[k]
+            s_prime = sqrt(s_k * scales[k + 1])
+            ratios = torch.tensor(aspect_ratios[k], dtype=torch.float64).sqrt()
+            sizes = torch.cat((torch.tensor([[s_k, s_k], [s_prime, s_prime]], dtype=torch.float64),
+                               torch.stack((s_k * ratios, s_k / ratios), 1)))
+
+            coordinates.append(torch.cat((centers.expand(f, f, sizes.size(0), 2),
+                                          sizes.expand(f, f, -1, 2)), -1).view(-1, 4))
+        coordinates = torch.cat(coordinates).float()
+
+        # clip prior boxes to fit the image
+        if clip:
+            coordinates = center_size(box_limits(coordinates).clamp_(min=0, max=1))
+        _coordinates_cache[key] = coordinates
+    return _coordinates_cache[key]
+
 
 class PriorBox(object):
     """Compute priorbox coordinates in center-offset form for each source
-    feature map.
+    feature map. The dimension of the feature maps is given by
+    feature_maps_dim, or config.feature_maps_dim if None.
     """
-    def __init__(self, config):
+    def __init__(self, config, feature_maps_dim=None):
         super(PriorBox, self).__init__()
         self.image_size = config.input_size
         # number of priors for feature map location (either 4 or 6)
         self.num_priors = len(config.prior_box_aspect_ratios)
         self.variance = config.prior_box_variance
-        self.feature_maps_dim = config.feature_maps_dim
+        self.feature_maps_dim = feature_maps_dim if feature_maps_dim is not None else config.feature_maps_dim
         self.scales = config.prior_box_scales
         self.aspect_ratios = config.prior_box_aspect_ratios
         self.clip = config.prior_box_clip
@@ -23,33 +64,5 @@ class PriorBox(object):
             if v <= 0:
                 raise ValueError('Variances must be greater than 0')
 
-        # Compute box coordinates
-        coordinates = []
-        s = self.scales
-        for k, f in enumerate(self.feature_maps_dim):
-            for i, j in product(range(f), repeat=2):
-                # unit center x,y
-                cx = (j + 0.5) / f
-                cy = (i + 0.5) / f
-
-                # aspect_ratio: 1
-                # rel size: min_size
-                coordinates += [cx, cy, s[k], s[k]]
-
-                # aspect_ratio: 1
-                # rel size: sqrt(s_k * s_(k+1))
-                s_prime = sqrt(s[k] * s[k+1])
-                coordinates += [cx, cy, s_prime, s_prime]
-
-                # rest of aspect ratios
-                for ar in self.aspect_ratios[k]:
-                    coordinates += [cx, cy, s[k] * sqrt(ar), s[k]/sqrt(ar)]
-        # back to torch land
-        coordinates_tensor = torch.Tensor(coordinates).view(-1, 4)
-
-        # clip prior boxes to fit the image
-        if self.clip:
-            coordinates_tensor = box_limits(coordinates_tensor)
-            coordinates_tensor = coordinates_tensor.clamp_(min=0, max=1)
-            coordinates_tensor = center_size(coordinates_tensor)
-        self.coordinates = coordinates_tensor
+        self.coordinates = prior_box_coordinates(self.image_size, self.feature_maps_dim, self.scales,
+                                                 self.aspect_ratios, self.clip)
@@ -17,6 +17,8 @@ class L2Norm(nn.Module):
         init.constant(self.weight,self.gamma)
 
     def forward(self, x):
+        # Normalize in fp32, since the sum of squares loses precision in bf16/fp16.
+        x = x.float()
         norm = x.pow(2).sum(dim=1, keepdim=True).sqrt()+self.eps
         #x /= norm
         x = torch.div(x,norm)
@@ -3,7 +3,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from ..box_utils import match, log_sum_exp
+from torch.nn.utils.rnn import pad_sequence
+from ..box_utils import match_batch, log_sum_exp
 
 
 class MultiBoxLoss(nn.Module):
@@ -17,6 +18,8 @@ class MultiBoxLoss(nn.Module):
         3) Hard negative mining to filter the excessive number of negative examples
            that comes with using a large number of default bounding boxes.
            (default negative:positive ratio 3:1)
+           The hardest negatives are found either by ranking all priors with two
+           sorts ('sort') or by a single top-k selection ('topk').
     Objective Loss:
         L(x,c,l,g) = (Lconf(x, c) + αLloc(x,l,g)) / N
         Where, Lconf is the CrossEntropy Loss and Lloc is the SmoothL1 Loss
@@ -31,7 +34,7 @@ class MultiBoxLoss(nn.Module):
 
     def __init__(self, config, overlap_thresh, prior_for_matching,
                  bkg_label, neg_mining, neg_pos, neg_overlap, encode_target,
-                 use_gpu=True):
+                 use_gpu=True, neg_mining_mode='topk'):
         super(MultiBoxLoss, self).__init__()
         self.use_gpu = use_gpu
         self.num_classes = config.num_classes
@@ -43,6 +46,9 @@ class MultiBoxLoss(nn.Module):
         self.negpos_ratio = neg_pos
         self.neg_overlap = neg_overlap
         self.variance = config.prior_box_variance
+        if neg_mining_mode not in ('sort', 'topk'):
+            raise ValueError("neg_mining_mode must be 'sort' or 'topk'.")
+        self.neg_mining_mode = neg_mining_mode
 
     def forward(self, predictions, targets):
         """Multibox Loss
@@ -57,22 +63,32 @@ class MultiBoxLoss(nn.Module):
                 shape: [batch_size,num_objs,5] (last idx is the label).
         """
         loc_data, conf_data, priors = predictions
+        # Compute the loss in fp32 when the network runs in mixed precision,
+        # so that log_sum_exp does not lose precision.
+        loc_data, conf_data = loc_data.float(), conf_data.float()
         num = loc_data.size(0)
         priors = priors[:loc_data.size(1), :]
         num_priors = (priors.size(0))
 
-        # match priors (default boxes) and ground truth boxes
-        loc_t = torch.Tensor(num, num_priors, 4)
-        conf_t = torch.LongTensor(num, num_priors)
-        for idx in range(num):
-            truths = targets[idx][:, :-1].data
-            labels = targets[idx][:, -1].data
-            defaults = priors.data
-            match(self.threshold, truths, defaults, self.variance, labels,
-                  loc_t, conf_t, idx)
-        if self.use_gpu:
-            loc_t = loc_t.cuda()
-            conf_t = conf_t.cuda()
+        # pad the ground truths of the batch to the same number of objects.
+        # Padding boxes never match a prior when the image has objects. They
+        # cover the whole image, so that the encoded targets of the background
+        # priors of images without objects stay finite.
+        padded_targets = pad_sequence([t.data for t in targets], batch_first=True, padding_value=0)
+        if padded_targets.size(1) == 0:
+            padded_targets = padded_targets.new_zeros(num, 1, 5)
+        num_objects = padded_targets.new_tensor([t.size(0) for t in targets], dtype=torch.long)
+        valid = torch.arange(padded_targets.size(1), device=padded_targets.device) < num_objects.unsqueeze(1)
+        padded_targets[:, :, 2:4].masked_fill_(~valid.unsqueeze(2), 1)
+        truths = padded_targets[:, :, :-1]
+        labels = padded_targets[:, :, -1].long()
+
+        # match priors (default boxes) and ground truth boxes of the whole batch
+        # on the device of the predictions.
+        loc_t = loc_data.data.new_empty(num, num_priors, 4)
+        conf_t = loc_data.data.new_empty(num, num_priors, dtype=torch.long)
+        match_batch(self.threshold, truths, priors.data, self.variance, labels,
+                    valid, loc_t, conf_t)
         # wrap targets
         loc_t = Variable(loc_t, requires_grad=False)
         conf_t = Variable(conf_t, requires_grad=False)
@@ -93,11 +109,19 @@ class MultiBoxLoss(nn.Module):
         # Hard Negative Mining
         loss_c = loss_c.view(num, -1)
         loss_c[pos] = 0  # filter out pos boxes for now
-        _, loss_idx = loss_c.sort(1, descending=True)
-        _, idx_rank = loss_idx.sort(1)
         num_pos = pos.long().sum(1, keepdim=True)
         num_neg = torch.clamp(self.negpos_ratio * num_pos, max=pos.size(1)-1)
-        neg = idx_rank < num_neg.expand_as(idx_rank)
+        if self.neg_mining_mode == 'topk':
+            # Only the largest num_neg losses of each row are needed, so select
+            # the top max(num_neg) losses instead of ranking all priors.
+            _, loss_idx = loss_c.data.topk(int(num_neg.max()), dim=1)
+            rank = torch.arange(loss_idx.size(1), device=loss_idx.device)
+            neg = torch.zeros_like(pos)
+            neg.scatter_(1, loss_idx, rank.unsqueeze(0) < num_neg)
+        else:
+            _, loss_idx = loss_c.sort(1, descending=True)
+            _, idx_rank = loss_idx.sort(1)
+            neg = idx_rank < num_neg.expand_as(idx_rank)
 
         # Confidence Loss Including Positive and Negative Examples
         pos_idx = pos.unsqueeze(2).expand_as(conf_data)
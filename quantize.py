@@ -0,0 +1,99 @@
+"""Quantize a trained network to int8 for CPU inference.
+
+    The base, extra and multibox layers are calibrated on a random subset of the dataset images, quantized and
+    exported with the detection layer to a TorchScript module, which eval.py evaluates when eval_model_format is set
+    to 'torchscript'. The latency and the precision/recall of the fp32 and int8 networks are compared on another
+    subset of images.
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import torch
+import torch.utils.data as data
+from data import build_dataset, detection_collate, BaseTransform
+from data.config import build_config, reformat_json
+from utils.benchmarks import time_function
+from utils.evaluation import detection_statistics
+from utils.export import export_torchscript
+from utils.inference import collect_detections, load_network
+from utils.quantization import quantize_heads
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector Quantization')
+parser.add_argument('--config', type=str,
+                    help='Name of configuration file.')
+parser.add_argument('--num_calibration_images', default=100, type=int,
+                    help='Number of images used to calibrate the quantization parameters')
+parser.add_argument('--num_eval_images', default=100, type=int,
+                    help='Number of images, distinct from the calibration images, on which the fp32 and int8 '
+                         'networks are compared')
+parser.add_argument('--backend', default=None, type=str,
+                    help="Quantized engine: 'x86', 'fbgemm' or 'qnnpack'. Defaults to the engine of the platform.")
+parser.add_argument('--output', default=None, type=str,
+                    help='Path of the quantized TorchScript module. Defaults to eval_model_name with a .int8.ts.pt '
+                         'extension.')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    configs = build_config(args.config)
+    # Quantized operators run on the CPU.
+    configs.eval.cuda = False
+
+    # Load neural net.
+    net = load_network(configs, 'state_dict', cuda=False)
+
+    # Split the dataset into calibration and evaluation images.
+    dataset = build_dataset(configs.dataset,
+                            transform=BaseTransform(configs.model.input_size, configs.model.pixel_means))
+    indices = np.random.RandomState(0).permutation(len(dataset)).tolist()
+    calibration_indices = indices[:args.num_calibration_images]
+    eval_indices = indices[args.num_calibration_images:args.num_calibration_images + args.num_eval_images]
+    if not eval_indices:
+        print('WARNING: All images are used for calibration. The networks are compared on the calibration images.')
+        eval_indices = calibration_indices[:args.num_eval_images]
+
+    # Calibrate and quantize.
+    calibration_loader = data.DataLoader(data.Subset(dataset, calibration_indices), configs.eval.batch_size,
+                                         num_workers=configs.eval.num_workers, collate_fn=detection_collate)
+    quantized_heads = quantize_heads(net, (images for images, _ in calibration_loader), args.backend)
+    output = args.output or os.path.splitext(configs.eval.model_name)[0] + '.int8.ts.pt'
+    quantized_net = export_torchscript(net, output, quantized_heads)
+    print('Saved the quantized network in {}'.format(output))
+
+    # Compare the latency and the detection statistics of the fp32 and int8 networks.
+    x = torch.stack([dataset[i][0] for i in eval_indices[:configs.eval.batch_size]])
+    report = {'calibration_images': len(calibration_indices), 'eval_images': len(eval_indices),
+              'backend': torch.backends.quantized.engine, 'batch_size': x.size(0)}
+    objects_gt = [dataset.get_gt(i) for i in eval_indices]
+    filenames = [dataset.filenames[i] for i in eval_indices]
+    classes_statistics = {}
+    for precision, model in (('fp32', net), ('int8', quantized_net)):
+        with torch.no_grad():
+            latency = time_function(lambda: model(x), N_repeats=5, N_warmup=1)
+        report[precision] = {'latency_ms_per_image': 1000 * latency / x.size(0)}
+        classes_statistics[precision] = detection_statistics(
+            collect_detections(configs, model, dataset, eval_indices), objects_gt, filenames,
+            configs.model.num_classes)
+    report['speedup'] = report['fp32']['latency_ms_per_image'] / report['int8']['latency_ms_per_image']
+    print('Latency per image: {:.1f} ms (fp32), {:.1f} ms (int8), {:.2f}x speedup'.format(
+        report['fp32']['latency_ms_per_image'], report['int8']['latency_ms_per_image'], report['speedup']))
+
+    if classes_statistics['fp32'] is not None:
+        for j, class_name in enumerate(dataset.classes_name):
+            fp32_stats, int8_stats = classes_statistics['fp32'][j], classes_statistics['int8'][j]
+            report[class_name] = {}
+            for name in ('Precision', 'Recall'):
+                report[class_name][name] = {'fp32': fp32_stats[name], 'int8': int8_stats[name],
+                                            'delta': int8_stats[name] - fp32_stats[name]}
+            print('{}: precision {:.4f} -> {:.4f} ({:+.4f}), recall {:.4f} -> {:.4f} ({:+.4f})'.format(
+                class_name, fp32_stats['Precision'], int8_stats['Precision'], report[class_name]['Precision']['delta'],
+                fp32_stats['Recall'], int8_stats['Recall'], report[class_name]['Recall']['delta']))
+    else:
+        print("No ground truths were found.")
+
+    report_filepath = os.path.splitext(output)[0] + '_report.json'
+    with open(report_filepath, 'w') as file:
+        file.write(reformat_json(json.dumps(report, indent=4)))
+    print('Saved the quantization report in {}'.format(report_filepath))
@@ -0,0 +1,42 @@
+"""Serve the detections of a trained network over HTTP.
+
+    POST /detect with an encoded image as body returns the detections in JSON format. Concurrent requests are
+    processed together in micro-batches.
+"""
+import argparse
+
+from data.config import build_config
+from utils.inference import load_network
+from utils.serving import MicroBatcher, SSDPredictor, make_server
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector Inference Server')
+parser.add_argument('--config', type=str,
+                    help='Name of configuration file.')
+parser.add_argument('--host', default='127.0.0.1', type=str,
+                    help='Address the server listens on')
+parser.add_argument('--port', default=8000, type=int,
+                    help='Port the server listens on')
+parser.add_argument('--batch_size', default=None, type=int,
+                    help='Maximum number of images per forward pass. Defaults to eval_batch_size.')
+parser.add_argument('--max_latency', default=10, type=float,
+                    help='Maximum time in ms a request waits for other requests to fill its batch')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    configs = build_config(args.config)
+
+    # Load neural net.
+    net = load_network(configs)
+
+    batch_size = args.batch_size or configs.eval.batch_size
+    batcher = MicroBatcher(SSDPredictor(net, configs), batch_size, args.max_latency / 1000)
+    server = make_server(batcher, args.host, args.port)
+    print('Serving {} on http://{}:{:d}/detect'.format(configs.eval.model_name, args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
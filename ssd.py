@@ -2,14 +2,15 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.nn.modules.utils import _pair
 from layers import *
 import os
 
 
 class SSD(nn.Module):
     """Single Shot Multibox Architecture
-    The network is composed of a base VGG network followed by the
-    added multibox conv layers.  Each multibox layer branches into
+    The network is composed of a base network (VGG16 or MobileNet) followed
+    by the added multibox conv layers.  Each multibox layer branches into
         1) conv2d for class conf scores
         2) conv2d for localization predictions
         3) associated priorbox layer to produce default bounding
@@ -19,24 +20,34 @@ class SSD(nn.Module):
     Args:
         phase: (string) Can be "test" or "train"
         size: input image size
-        base: VGG16 layers for input, size of either 300 or 500
+        base: base network layers
         extras: extra layers that feed to multibox loc and conf layers
         head: "multibox head" consists of loc and conf conv layers
+        feature_maps_dim: square dimension of the source feature maps
+        source_end: number of base layers up to the first source feature map
     """
 
-    def __init__(self, phase, size, base, extras, head, config):
+    def __init__(self, phase, size, base, extras, head, config, feature_maps_dim, source_end):
         super(SSD, self).__init__()
         self.phase = phase
         self.num_classes = config.num_classes
         self.config = config
-        self.priorbox = PriorBox(self.config)
+        self.priorbox = PriorBox(self.config, feature_maps_dim)
         self.priors = Variable(self.priorbox.coordinates, volatile=True)
         self.size = size
+        # In the optimized build, the activations are kept in channels_last
+        # memory format, so that the permutes of the multibox heads are views.
+        # The convolutions and their ReLU are fused in TorchScript exports
+        # (see utils/export.py).
+        self.channels_last = config.build_mode == 'optimized'
+        self.source_end = source_end
 
         # SSD network
+        # The base network keeps the name vgg, so that the weights of the
+        # trained networks load whatever the base network.
         self.vgg = nn.ModuleList(base)
         # Layer learns to scale the l2 normalized features from conv4_3
-        self.L2Norm = L2Norm(512, 20)
+        self.L2Norm = L2Norm(head[0][0].in_channels, 20)
         self.extras = nn.ModuleList(extras)
 
         self.loc = nn.ModuleList(head[0])
@@ -44,13 +55,14 @@ class SSD(nn.Module):
 
         if phase == 'test':
             self.softmax = nn.Softmax(dim=-1)
-            self.detect = Detect(self.num_classes, 0, 200, 0.3, 0.45)
+            self.detect = Detect(self.num_classes, 0, 200, 0.3, 0.45,
+                                 config.nms_engine)
 
     def forward(self, x):
         """Applies network layers and ops on input image(s) x.
 
         Args:
-            x: input image or batch of images. Shape: [batch,3,300,300].
+            x: input image or batch of images. Shape: [batch,3,size,size].
 
         Return:
             Depending on phase:
@@ -65,19 +77,44 @@ class SSD(nn.Module):
                     2: localization layers, Shape: [batch,num_priors*4]
                     3: priorbox layers, Shape: [2,num_priors*4]
         """
+        loc, conf = self.predict(x)
+        if self.phase == "test":
+            # Decode the boxes in fp32 when the network runs in mixed precision.
+            output = self.detect(
+                loc.float(),                                    # loc preds
+                self.softmax(conf.float()),                     # conf preds
+                self.priors.type(type(loc.data))                # default boxes
+            )
+        else:
+            output = (
+                loc,
+                conf,
+                self.priors
+            )
+        return output
+
+    def predict(self, x):
+        """Applies the base, extra and multibox layers on input image(s) x.
+
+        Return:
+            location predictions, Shape: [batch,num_priors,4]
+            class confidence predictions before softmax, Shape: [batch,num_priors,num_classes]
+        """
         sources = list()
         loc = list()
         conf = list()
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
 
         # apply vgg up to conv4_3 relu
-        for k in range(23):
+        for k in range(self.source_end):
             x = self.vgg[k](x)
 
         s = self.L2Norm(x)
         sources.append(s)
 
         # apply vgg up to fc7
-        for k in range(23, len(self.vgg)):
+        for k in range(self.source_end, len(self.vgg)):
             x = self.vgg[k](x)
         sources.append(x)
 
@@ -94,20 +131,7 @@ class SSD(nn.Module):
 
         loc = torch.cat([o.view(o.size(0), -1) for o in loc], 1)
         conf = torch.cat([o.view(o.size(0), -1) for o in conf], 1)
-        if self.phase == "test":
-            output = self.detect(
-                loc.view(loc.size(0), -1, 4),                   # loc preds
-                self.softmax(conf.view(conf.size(0), -1,
-                             self.num_classes)),                # conf preds
-                self.priors.type(type(x.data))                  # default boxes
-            )
-        else:
-            output = (
-                loc.view(loc.size(0), -1, 4),
-                conf.view(conf.size(0), -1, self.num_classes),
-                self.priors
-            )
-        return output
+        return loc.view(loc.size(0), -1, 4), conf.view(conf.size(0), -1, self.num_classes)
 
     def load_weights(self, base_file):
         other, ext = os.path.splitext(base_file)
@@ -145,6 +169,31 @@ def vgg(cfg, i, batch_norm=False):
     return layers
 
 
+def mobilenet(cfg, i):
+    # MobileNet-style base network made of depthwise separable convolutions.
+    # The first convolution is a standard convolution and 'S' halves the
+    # dimension of the next convolution.
+    layers = []
+    in_channels = i
+    stride = 1
+    for v in cfg:
+        if v == 'S':
+            stride = 2
+            continue
+        if in_channels == i:
+            layers += [nn.Conv2d(in_channels, v, kernel_size=3, stride=stride, padding=1, bias=False),
+                       nn.BatchNorm2d(v), nn.ReLU(inplace=True)]
+        else:
+            layers += [nn.Conv2d(in_channels, in_channels, kernel_size=3, stride=stride, padding=1,
+                                 groups=in_channels, bias=False),
+                       nn.BatchNorm2d(in_channels), nn.ReLU(inplace=True),
+                       nn.Conv2d(in_channels, v, kernel_size=1, bias=False),
+                       nn.BatchNorm2d(v), nn.ReLU(inplace=True)]
+        in_channels = v
+        stride = 1
+    return layers
+
+
 def add_extras(cfg, i, batch_norm=False):
     # Extra layers added to VGG for feature scaling
     layers = []
@@ -162,14 +211,19 @@ def add_extras(cfg, i, batch_norm=False):
     return layers
 
 
-def multibox(vgg, extra_layers, mbox, num_classes):
+def out_channels(layers):
+    # Number of channels of the output of a sequence of layers.
+    return [layer.out_channels for layer in layers if isinstance(layer, nn.Conv2d)][-1]
+
+
+def multibox(vgg, extra_layers, mbox, num_classes, source_end):
     loc_layers = []
     conf_layers = []
-    vgg_source = [21, -2]
+    vgg_source = [vgg[:source_end], vgg]
     for k, v in enumerate(vgg_source):
-        loc_layers += [nn.Conv2d(vgg[v].out_channels,
+        loc_layers += [nn.Conv2d(out_channels(v),
                                  mbox[k] * 4, kernel_size=3, padding=1)]
-        conf_layers += [nn.Conv2d(vgg[v].out_channels,
+        conf_layers += [nn.Conv2d(out_channels(v),
                                   mbox[k] * num_classes, kernel_size=3, padding=1)]
     for k, v in enumerate(extra_layers[1::2], 2):
         loc_layers += [nn.Conv2d(v.out_channels, mbox[k]
@@ -179,19 +233,65 @@ def multibox(vgg, extra_layers, mbox, num_classes):
     return vgg, extra_layers, (loc_layers, conf_layers)
 
 
+def layer_output_size(layer, size):
+    """Square dimension of the output of a layer given the dimension of its input."""
+    if isinstance(layer, nn.Conv2d):
+        ceil_mode = False
+    elif isinstance(layer, nn.MaxPool2d):
+        ceil_mode = layer.ceil_mode
+    else:
+        return size
+    kernel_size, stride, padding, dilation = [_pair(p)[0] for p in (layer.kernel_size, layer.stride,
+                                                                    layer.padding, layer.dilation)]
+    extent = size + 2 * padding - dilation * (kernel_size - 1) - 1
+    out_size = (-(-extent // stride) if ceil_mode else extent // stride) + 1
+    # the last pooling window must start inside the input or the left padding
+    if ceil_mode and (out_size - 1) * stride >= size + padding:
+        out_size -= 1
+    return out_size
+
+
+def infer_feature_maps_dim(vgg, extra_layers, size, source_end):
+    """Square dimension of each source feature map of the multibox layers for
+    an input image of dimension size.
+    """
+    feature_maps_dim = []
+    for k, layer in enumerate(vgg):
+        size = layer_output_size(layer, size)
+        if k == source_end - 1:
+            feature_maps_dim.append(size)
+    feature_maps_dim.append(size)
+    for k, layer in enumerate(extra_layers):
+        size = layer_output_size(layer, size)
+        if k % 2 == 1:
+            feature_maps_dim.append(size)
+    return feature_maps_dim
+
+
+# Registry of the base networks: layers constructor, layers configuration and
+# number of layers up to the first source feature map. The source feature maps
+# of every base network have strides 8 and 16, like conv4_3 and fc7 of VGG16.
+# The layers of SSD300 are used at every input size. The dimension of the
+# feature maps and the number of priors grow with the input size.
 base = {
-    '300': [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'C', 512, 512, 512, 'M',
-            512, 512, 512],
-    '512': [],
-}
-extras = {
-    '300': [256, 'S', 512, 128, 'S', 256, 128, 256, 128, 256],
-    '512': [],
-}
-mbox = {
-    '300': [4, 6, 6, 6, 4, 4],  # number of boxes per feature map location
-    '512': [],
+    'vgg16': (vgg, [64, 64, 'M', 128, 128, 'M', 256, 256, 256, 'C', 512, 512, 512, 'M',
+                    512, 512, 512], 23),
+    'mobilenet': (mobilenet, ['S', 32, 64, 'S', 128, 128, 'S', 256, 256, 512,
+                              'S', 512, 512, 512, 512, 512, 1024], 39),
 }
+extras = [256, 'S', 512, 128, 'S', 256, 128, 256, 128, 256]
+
+
+def base_network_name(basenet):
+    """Name of the base network selected by basenet, which is either the name
+    of a base network or the filename of its pretrained weights, starting with
+    the name of the base network (e.g. vgg16_reducedfc.pth).
+    """
+    name = os.path.splitext(os.path.basename(basenet))[0]
+    for base_name in base:
+        if name == base_name or name.startswith(base_name + '_'):
+            return base_name
+    return None
 
 
 def build_ssd(phase, config):
@@ -199,11 +299,40 @@ def build_ssd(phase, config):
     if phase != "test" and phase != "train":
         print("ERROR: Phase: " + phase + " not recognized")
         return
-    if size != 300:
-        print("ERROR: You specified size " + repr(size) + ". However, " +
-              "currently only SSD300 (size=300) is supported!")
+    if config.build_mode not in ('default', 'optimized'):
+        print("ERROR: Build mode " + repr(config.build_mode) + " not recognized")
+        return
+    base_name = base_network_name(config.basenet)
+    if base_name is None:
+        print("ERROR: Base network " + repr(config.basenet) + " not recognized. " +
+              "Base networks: " + ", ".join(base))
         return
-    base_, extras_, head_ = multibox(vgg(base[str(size)], 3),
-                                     add_extras(extras[str(size)], 1024),
-                                     mbox[str(size)], config.num_classes)
-    return SSD(phase, size, base_, extras_, head_, config)
+    layers, cfg, source_end = base[base_name]
+    vgg_ = layers(cfg, 3)
+    extras_ = add_extras(extras, out_channels(vgg_))
+
+    # Infer the dimension of the feature maps from the input size.
+    feature_maps_dim = infer_feature_maps_dim(vgg_, extras_, size, source_end)
+    if min(feature_maps_dim) < 1:
+        print("ERROR: The input size " + repr(size) + " is too small. " +
+              "The feature maps dimensions are " + repr(feature_maps_dim))
+        return
+    if config.feature_maps_dim is not None and list(config.feature_maps_dim) != feature_maps_dim:
+        print("ERROR: The feature maps dimensions " + repr(config.feature_maps_dim) +
+              " do not match the input size " + repr(size) + ". The dimensions " +
+              "are " + repr(feature_maps_dim))
+        return
+    if len(config.prior_box_aspect_ratios) != len(feature_maps_dim) or \
+            len(config.prior_box_scales) != len(feature_maps_dim) + 1:
+        print("ERROR: " + repr(len(feature_maps_dim)) + " prior box aspect " +
+              "ratios lists and " + repr(len(feature_maps_dim) + 1) + " scales " +
+              "are required")
+        return
+
+    # number of boxes per feature map location
+    mbox = [2 + len(aspect_ratios) for aspect_ratios in config.prior_box_aspect_ratios]
+    base_, extras_, head_ = multibox(vgg_, extras_, mbox, config.num_classes, source_end)
+    net = SSD(phase, size, base_, extras_, head_, config, feature_maps_dim, source_end)
+    if config.build_mode == 'optimized':
+        net = net.to(memory_format=torch.channels_last)
+    return net
@@ -0,0 +1,226 @@
+# Checks of the detection, evaluation, serving and export routines.
+import json
+import os
+import tempfile
+import threading
+import urllib.request
+
+import cv2
+import numpy as np
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from layers import Detect
+from layers.box_utils import decode, match, match_batch, nms, matrix_nms
+from utils.evaluation import match_detections, match_image_detections, precision_recall_sweep
+from utils.benchmarks import random_evaluation_inputs
+from utils.serving import MicroBatcher, make_server
+from utils.export import FusedSSD, export_torchscript, load_torchscript
+from utils.quantization import quantize_heads
+from utils.precision import autocast
+from data.config import get_default_configs, build_config
+from ssd import build_ssd
+
+
+def test_matrix_nms(N_trials=20, N_boxes=200, overlap=0.45):
+    """Check that matrix_nms keeps the same boxes as the greedy nms on random boxes."""
+    for _ in range(N_trials):
+        # Random boxes with distinct scores sorted in descending order.
+        corners = torch.rand(N_boxes, 2)
+        boxes = torch.cat((corners, corners + 0.05 + 0.2 * torch.rand(N_boxes, 2)), 1)
+        scores, _ = torch.rand(N_boxes).sort(descending=True)
+
+        keep_ids, count = nms(boxes, scores, overlap, N_boxes)
+        greedy_keep = torch.zeros(N_boxes, dtype=torch.bool)
+        greedy_keep[keep_ids[:count]] = True
+
+        candidates = torch.ones(1, N_boxes, dtype=torch.bool)
+        matrix_keep = matrix_nms(boxes.unsqueeze(0), candidates, overlap)[0]
+        assert torch.equal(greedy_keep, matrix_keep), 'matrix_nms differs from the greedy nms.'
+
+
+def legacy_detect(detect, loc_data, conf_data, prior_data):
+    """Loop over the images and the classes of the batch, as Detect did before the batched nms."""
+    num, num_priors = loc_data.size(0), prior_data.size(0)
+    output = torch.zeros(num, detect.num_classes, detect.top_k, 5)
+    conf_preds = conf_data.view(num, num_priors, detect.num_classes).transpose(2, 1)
+    for i in range(num):
+        decoded_boxes = decode(loc_data[i], prior_data, detect.variance)
+        for cl in range(1, detect.num_classes):
+            c_mask = conf_preds[i, cl].gt(detect.conf_thresh)
+            scores = conf_preds[i, cl][c_mask]
+            if scores.nelement() == 0:
+                continue
+            boxes = decoded_boxes[c_mask]
+            ids, count = nms(boxes, scores, detect.nms_thresh, detect.top_k)
+            output[i, cl, :count] = torch.cat((scores[ids[:count]].unsqueeze(1), boxes[ids[:count]]), 1)
+    return output
+
+
+def test_detect(N_trials=5, N_images=4, N_priors=500, num_classes=4, top_k=50):
+    """Check that Detect gives the detections of the loop over the images and the classes on random predictions.
+
+    Detections may only be reordered where their scores tie exactly.
+    """
+    for nms_engine in Detect.nms_engines:
+        detect = Detect(num_classes, 0, top_k, 0.01, 0.45, nms_engine)
+        for _ in range(N_trials):
+            priors = torch.cat((torch.rand(N_priors, 2), 0.05 + 0.25 * torch.rand(N_priors, 2)), 1)
+            loc = 0.5 * torch.randn(N_images, N_priors, 4)
+            conf = torch.softmax(2 * torch.randn(N_images * N_priors, num_classes), -1)
+            detections = detect(loc, conf, priors)
+            expected = legacy_detect(detect, loc, conf, priors)
+            assert detections.shape == (N_images, num_classes, top_k, 5)
+            assert torch.equal(detections[..., 0], expected[..., 0]), \
+                'The scores of the {} engine differ.'.format(nms_engine)
+            # Sort the detections of each (image, class) pair by score, then by box, to undo the reordering of ties.
+            for group, expected_group in zip(detections.view(-1, top_k, 5).numpy(),
+                                             expected.view(-1, top_k, 5).numpy()):
+                order, expected_order = np.lexsort(group.T[::-1]), np.lexsort(expected_group.T[::-1])
+                assert np.array_equal(group[order], expected_group[expected_order]), \
+                    'The boxes of the {} engine differ.'.format(nms_engine)
+
+
+def test_match_batch(N_trials=5, N_images=6, N_priors=300, threshold=0.5, variances=(0.1, 0.2)):
+    """Check that match_batch gives the targets of match called on each image, when ground truths or priors tie."""
+    for _ in range(N_trials):
+        priors = torch.cat((torch.rand(N_priors, 2), 0.05 + 0.25 * torch.rand(N_priors, 2)), 1)
+        # Duplicated priors tie for the best prior of a ground truth.
+        priors[N_priors // 2:] = priors[:N_priors - N_priors // 2]
+        truths, labels = [], []
+        for i in range(N_images):
+            corners = 0.8 * torch.rand(i + 1, 2)
+            image_truths = torch.cat((corners, corners + 0.05 + 0.15 * torch.rand(i + 1, 2)), 1)
+            # Duplicated ground truths share their best prior and tie for the best ground truth of the priors.
+            truths.append(torch.cat((image_truths, image_truths[:(i + 1) // 2])))
+            labels.append(torch.randint(3, (truths[-1].size(0),)))
+
+        loc_t = torch.empty(N_images, N_priors, 4)
+        conf_t = torch.empty(N_images, N_priors, dtype=torch.long)
+        for i in range(N_images):
+            match(threshold, truths[i], priors, variances, labels[i], loc_t, conf_t, i)
+        valid = pad_sequence([torch.ones(len(x), dtype=torch.bool) for x in labels], batch_first=True)
+        padded_truths = pad_sequence(truths, batch_first=True)
+        padded_truths[:, :, 2:4].masked_fill_(~valid.unsqueeze(2), 1)
+        batch_loc_t = torch.empty(N_images, N_priors, 4)
+        batch_conf_t = torch.empty(N_images, N_priors, dtype=torch.long)
+        match_batch(threshold, padded_truths, priors, variances, pad_sequence(labels, batch_first=True), valid,
+                    batch_loc_t, batch_conf_t)
+        assert torch.equal(batch_conf_t, conf_t), 'The matched classes differ.'
+        assert torch.equal(batch_loc_t, loc_t), 'The encoded locations differ.'
+
+
+def test_match_detections(N_images=500, min_jaccard_overlap=0.5):
+    """Check that the vectorized matching gives the same counts and overlaps as the loop over the images."""
+    gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores = random_evaluation_inputs(N_images)
+    results = match_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores, N_images,
+                               min_jaccard_overlap)
+    for i in range(N_images):
+        gts = gt_image_ids == i
+        dets = det_image_ids == i
+        expected = match_image_detections(gt_boxes[gts], det_boxes[dets], det_scores[dets], min_jaccard_overlap)
+        assert [x[i] for x in results[:3]] == list(expected[:3]), 'Counts differ in image {:d}.'.format(i)
+        assert np.allclose(results[3][i], expected[3], equal_nan=True), 'Overlaps differ in image {:d}.'.format(i)
+
+
+def test_precision_recall_sweep(N_images=300, iou_thresholds=(0.3, 0.5, 0.75)):
+    """Check that the swept precision and recall match the counts of match_detections at each confidence threshold."""
+    gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores = random_evaluation_inputs(N_images)
+    confidence_thresholds = np.linspace(0, 1, 11)
+    curves = precision_recall_sweep(gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores, N_images,
+                                    iou_thresholds, confidence_thresholds)
+    for iou_threshold in iou_thresholds:
+        for k, confidence_threshold in enumerate(confidence_thresholds):
+            kept = det_scores >= confidence_threshold
+            true_pos, false_pos, false_neg, _ = match_detections(gt_boxes, gt_image_ids, det_boxes[kept],
+                                                                 det_image_ids[kept], det_scores[kept], N_images,
+                                                                 iou_threshold)
+            true_pos, false_pos, false_neg = true_pos.sum(), false_pos.sum(), false_neg.sum()
+            precision = true_pos / (true_pos + false_pos) if true_pos + false_pos else 1.
+            assert np.isclose(curves[iou_threshold]['precision'][k], precision), 'Precisions differ.'
+            assert np.isclose(curves[iou_threshold]['recall'][k], true_pos / (true_pos + false_neg)), 'Recalls differ.'
+
+
+def test_inference_server(N_requests=16, max_batch_size=8):
+    """Check that concurrent requests to a local server are batched and answered with their own result."""
+    # Predictor returning the mean pixel value of each image.
+    batcher = MicroBatcher(lambda images: [[{'mean': float(image.mean())}] for image in images], max_batch_size,
+                           max_latency=0.05)
+    server = make_server(batcher, '127.0.0.1', 0)
+    url = 'http://127.0.0.1:{:d}/detect'.format(server.server_address[1])
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    responses = [None] * N_requests
+
+    def post(k):
+        _, image_bytes = cv2.imencode('.png', np.full((32, 32, 3), k, dtype=np.uint8))
+        request = urllib.request.Request(url, data=image_bytes.tobytes(), method='POST')
+        responses[k] = json.load(urllib.request.urlopen(request))
+
+    threads = [threading.Thread(target=post, args=(k,)) for k in range(N_requests)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+    batcher.close()
+
+    assert [response['detections'][0]['mean'] for response in responses] == list(range(N_requests))
+    assert max(batcher.batch_sizes) <= max_batch_size and len(batcher.batch_sizes) < N_requests, \
+        'Requests were not batched: {}'.format(batcher.batch_sizes)
+
+
+def test_torchscript_export(N_images=3):
+    """Check that the exported TorchScript module returns the detections of the eager network on random images, in
+    fp32 and in bf16 mixed precision. The layers of the network built in optimized mode must be fused on load.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for nms_engine, build_mode in (('batched', 'default'), ('matrix', 'default'), ('batched', 'optimized')):
+            configs_dict = get_default_configs()
+            configs_dict.update({'dataset_dir': tmp_dir, 'model_nms_engine': nms_engine,
+                                 'model_build_mode': build_mode})
+            configs = build_config(configs_dict)
+            torch.manual_seed(0)
+            net = build_ssd('test', configs.model)
+            net.eval()
+
+            filepath = os.path.join(tmp_dir, 'ssd.ts.pt')
+            export_torchscript(net, filepath)
+            exported_net = load_torchscript(filepath)
+            assert isinstance(exported_net, FusedSSD) == (build_mode == 'optimized')
+            x = 255 * torch.rand(N_images, 3, configs.model.input_size, configs.model.input_size)
+            for precision in ('fp32', 'bf16'):
+                with torch.no_grad(), autocast(precision):
+                    detections = net(x)
+                    # The fused layers are compiled during the first two calls.
+                    for _ in range(3):
+                        exported_detections = exported_net(x)
+                assert detections.gt(0).any(), 'The network has no detections.'
+                assert torch.allclose(detections, exported_detections, atol=1e-5), \
+                    'The detections of the exported {} {} network differ in {}.'.format(build_mode, nms_engine,
+                                                                                       precision)
+            if build_mode == 'optimized':
+                with torch.no_grad(), torch.jit.fuser('fuser3'):
+                    exported_net.heads(x)
+                assert torch.jit.last_executed_optimized_graph().findAllNodes('prim::oneDNNFusionGroup'), \
+                    'The layers of the optimized network are not fused.'
+
+
+def test_quantized_l2norm(N_images=2):
+    """Check that the L2Norm layer of a quantized network runs in fp32, so that null conv4_3 features are finite."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs_dict = get_default_configs()
+        configs_dict['dataset_dir'] = tmp_dir
+        configs = build_config(configs_dict)
+    torch.manual_seed(0)
+    net = build_ssd('test', configs.model)
+    net.eval()
+    # conv4_3 outputs zeros, whose norm is only the epsilon of L2Norm.
+    net.vgg[21].weight.data.zero_()
+    net.vgg[21].bias.data.zero_()
+    x = 255 * torch.rand(N_images, 3, configs.model.input_size, configs.model.input_size)
+    quantized_heads = quantize_heads(net, [x])
+    assert not any(node.target in (torch.ops.quantized.add, torch.ops.quantized.mul)
+                   for node in quantized_heads.graph.nodes), 'The L2Norm layer is quantized.'
+    with torch.no_grad():
+        loc, conf = quantized_heads(x)
+    assert torch.isfinite(loc).all() and torch.isfinite(conf).all(), 'The quantized network outputs are not finite.'
@@ -14,7 +14,13 @@ import torch.optim as optim
 import torch.backends.cudnn as cudnn
 import torch.nn.init as init
 import torch.utils.data as data
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
 import numpy as np
+from utils.batch_augmentations import BatchTreeAugmentation
+from utils.distributed import init_process, numa_node_cpus
+from utils.precision import autocast, grad_scaler
 
 
 def str2bool(v):
@@ -56,6 +62,16 @@ parser.add_argument('--visdom', default=False, type=str2bool,
                     help='Use visdom for loss visualization')
 parser.add_argument('--weights_dir', default='weights/',
                     help='Directory for saving checkpoint models')
+parser.add_argument('--distributed', default=False, type=str2bool,
+                    help='Train with one CPU process per NUMA node using torch.distributed')
+parser.add_argument('--dist_url', default='tcp://127.0.0.1:23456', type=str,
+                    help='Address of the rank 0 process')
+parser.add_argument('--dist_num_nodes', default=1, type=int,
+                    help='Number of machines taking part in distributed training')
+parser.add_argument('--dist_node_rank', default=0, type=int,
+                    help='Rank of this machine in distributed training')
+parser.add_argument('--dist_procs_per_node', default=None, type=int,
+                    help='Number of training processes per machine')
 args = parser.parse_args()
 
 # Build the configuration object.
@@ -75,6 +91,8 @@ for config_name in input_args.keys():
         setattr(configs.train, config_name, getattr(args, config_name))
 
 # Cuda configs
+if configs.train.cuda and configs.train.distributed:
+    raise Exception('Distributed training runs on CPU processes. Set train_cuda to false.')
 if configs.train.cuda:
     if not torch.cuda.is_available():
         raise Exception('Cuda is not available.')
@@ -96,9 +114,37 @@ if configs.train.visdom:
     vis_legend = ['Loc Loss', 'Conf Loss', 'Total Loss']
 
 
-def train():
+def main():
+    if configs.train.distributed:
+        # Spawn the training processes of this machine.
+        procs_per_node = configs.train.dist_procs_per_node or len(numa_node_cpus())
+        mp.spawn(train, args=(procs_per_node,), nprocs=procs_per_node)
+    else:
+        train()
+
+
+def train(local_rank=0, procs_per_node=1):
+    # Initialize the process group. Only the rank 0 process logs and saves checkpoints.
+    rank, world_size = 0, 1
+    if configs.train.distributed:
+        rank, world_size = init_process(local_rank, procs_per_node, configs.train.dist_num_nodes,
+                                        configs.train.dist_node_rank, configs.train.dist_url)
+    main_process = rank == 0
+    if not main_process:
+        sys.stdout = open(os.devnull, 'w')
+        configs.train.visdom = False
+
     # Load dataset.
-    dataset = TreeDataset(configs.dataset, transform=configs.dataset.augmentation)
+    if configs.train.distributed:
+        # The annotation index and the image cache are built by one process at a time per file system: the rank 0
+        # process first, then the first process of each other node. The other processes find the caches up to date.
+        build_stage = 0 if rank == 0 else 1 if local_rank == 0 else 2
+        for stage in range(3):
+            if stage == build_stage:
+                dataset = build_dataset(configs.dataset, transform=configs.dataset.augmentation)
+            dist.barrier()
+    else:
+        dataset = build_dataset(configs.dataset, transform=configs.dataset.augmentation)
 
     # Initialize net.
     net = build_ssd('train', configs.model)
@@ -125,9 +171,13 @@ def train():
             print('Load weights only.')
             net.load_weights(configs.train.resume)
     else:
-        print('Loading base network...')
-        vgg_weights = torch.load(configs.model.basenet, map_location=Map_loc)
-        net.vgg.load_state_dict(vgg_weights)
+        if os.path.splitext(configs.model.basenet)[1]:
+            print('Loading base network...')
+            vgg_weights = torch.load(configs.model.basenet, map_location=Map_loc)
+            net.vgg.load_state_dict(vgg_weights)
+        else:
+            print('Training the base network {} from scratch.'.format(os.path.basename(configs.model.basenet)))
+            net.vgg.apply(weights_init)
 
         print('Initializing weights...')
         # initialize newly added layers' weights with xavier method
@@ -139,14 +189,21 @@ def train():
         net = torch.nn.DataParallel(net)
         cudnn.benchmark = True
         net = net.cuda()
+    elif configs.train.distributed:
+        net = DistributedDataParallel(net)
 
     # Initialize optimizer and criterion.
     optimizer = optim.SGD(net.parameters(), lr=configs.train.lr_init, momentum=configs.train.momentum,
                           weight_decay=configs.train.weight_decay)
     criterion = MultiBoxLoss(configs.model, 0.5, True, 0, True, 3, 0.5,
-                             False, configs.train.cuda)
+                             False, configs.train.cuda, configs.criterion.hard_negative_mining)
+    scaler = grad_scaler(configs.train.precision, configs.train.cuda)
     net.train()
     print('Training SSD on:', dataset.name, 'for {} epochs.'.format(configs.train.num_epochs))
+    print('Precision: {}'.format(configs.train.precision))
+    if configs.train.distributed:
+        print('Distributed training with {:d} processes. Effective batch size: {:d}'.format(
+            world_size, world_size * configs.dataloader.batch_size))
     print('Using the following configurations:')
     print(configs)
 
@@ -156,11 +213,16 @@ def train():
         iter_plot = create_vis_plot(0, 0, 'Iteration', 'Loss', vis_title, vis_legend)
         epoch_plot = create_vis_plot(configs.train.start_epoch, 0, 'Epoch', 'Loss', vis_title, vis_legend)
 
+    # Each process trains on its own shard of the dataset.
+    sampler = None
+    if configs.train.distributed:
+        sampler = data.distributed.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True)
     data_loader = data.DataLoader(dataset, configs.dataloader.batch_size,
                                   num_workers=configs.dataloader.num_workers,
-                                  shuffle=True, collate_fn=detection_collate,
+                                  shuffle=sampler is None, sampler=sampler, collate_fn=detection_collate,
                                   pin_memory=True)
     N_iterations = len(dataset)
+    batch_augmentation = isinstance(configs.dataset.augmentation, BatchTreeAugmentation)
     for epoch in range(configs.train.start_epoch, configs.train.num_epochs):
         # reset epoch losses
         epoch_loc_loss = 0
@@ -170,25 +232,31 @@ def train():
 
         if epoch in configs.train.lr_schedule:
             adjust_learning_rate(epoch, optimizer)
+        if sampler is not None:
+            sampler.set_epoch(epoch)
 
         # loop through all batches
         t0 = time.time()
         for iteration, (images, targets) in enumerate(data_loader):
             if configs.train.cuda:
-                images = Variable(images.cuda())
-                targets = [Variable(ann.cuda(), volatile=True) for ann in targets]
-            else:
-                images = Variable(images)
-                targets = [Variable(ann, volatile=True) for ann in targets]
+                images = images.cuda()
+                targets = [ann.cuda() for ann in targets]
+            if batch_augmentation:
+                # Augment the whole batch at once on the training device.
+                images, targets = configs.dataset.augmentation.augment_batch(images, targets)
+            images = Variable(images)
+            targets = [Variable(ann, volatile=True) for ann in targets]
             # forward prop
-            out = net(images)
+            with autocast(configs.train.precision, configs.train.cuda):
+                out = net(images)
 
             # backward prop
             optimizer.zero_grad()
             loss_l, loss_c = criterion(out, targets)
             loss = loss_l + loss_c
-            loss.backward()
-            optimizer.step()
+            scaler.scale(loss).backward()
+            scaler.step(optimizer)
+            scaler.update()
 
             # save epoch losses
             epoch_loc_loss += loss_l.data[0]
@@ -207,14 +275,22 @@ def train():
             if configs.train.visdom:
                 update_vis_plot(iteration + 1, iter_plot, loss_l.data[0], loss_c.data[0])
 
+        # average the epoch losses over the processes.
+        if configs.train.distributed:
+            epoch_losses = torch.Tensor([epoch_loc_loss, epoch_conf_loss])
+            dist.all_reduce(epoch_losses)
+            epoch_loc_loss, epoch_conf_loss = (epoch_losses / world_size).tolist()
+            epoch_total_loss = epoch_loc_loss + epoch_conf_loss
+            epoch_avg_loss = epoch_total_loss / ((iteration + 1) * configs.dataloader.batch_size)
+
         # update epoch loss plot.
         if configs.train.visdom:
             update_vis_plot(epoch + 1, epoch_plot, epoch_loc_loss / N_iterations, epoch_conf_loss / N_iterations)
 
         # save checkpoint.
-        if epoch != 0 and epoch % 2 == 0:
+        if main_process and epoch != 0 and epoch % 2 == 0:
             print('Saving checkpoint, epoch:', epoch)
-            if configs.train.cuda:
+            if configs.train.cuda or configs.train.distributed:
                 net_weights = net.module
             else:
                 net_weights = net
@@ -224,14 +300,17 @@ def train():
                             epoch_total_loss, epoch_avg_loss, checkpoint_path)
 
     # save final state.
-    if configs.train.cuda:
-        net_weights = net.module
-    else:
-        net_weights = net
-    checkpoint_filename = 'ssd300_' + configs.dataset.name + '_Final.pth'
-    checkpoint_path = os.path.join(configs.output.weights_dir, checkpoint_filename)
-    save_checkpoint(net_weights, configs.train.lr, epoch, epoch_loc_loss, epoch_conf_loss,
-                    epoch_total_loss, epoch_avg_loss, checkpoint_path)
+    if main_process:
+        if configs.train.cuda or configs.train.distributed:
+            net_weights = net.module
+        else:
+            net_weights = net
+        checkpoint_filename = 'ssd300_' + configs.dataset.name + '_Final.pth'
+        checkpoint_path = os.path.join(configs.output.weights_dir, checkpoint_filename)
+        save_checkpoint(net_weights, configs.train.lr, epoch, epoch_loc_loss, epoch_conf_loss,
+                        epoch_total_loss, epoch_avg_loss, checkpoint_path)
+    if configs.train.distributed:
+        dist.destroy_process_group()
 
 
 def adjust_learning_rate(epoch, optimizer=None):
@@ -254,7 +333,8 @@ def xavier(param):
 def weights_init(m):
     if isinstance(m, nn.Conv2d):
         xavier(m.weight.data)
-        m.bias.data.zero_()
+        if m.bias is not None:
+            m.bias.data.zero_()
 
 
 def save_checkpoint(net, lr, epoch, epoch_loc_loss, epoch_conf_loss, epoch_total_loss, epoch_avg_loss, filename):
@@ -292,4 +372,4 @@ def update_vis_plot(iteration, window_id, loc, conf):
 
 
 if __name__ == '__main__':
-    train()
+    main()
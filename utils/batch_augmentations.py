@@ -0,0 +1,244 @@
+import math
+import torch
+from .augmentations import Compose, ToPercentCoords, Resize
+
+# Weights of the (B, G, R) channels used to compute the luminance.
+BGR_LUMINANCE = (0.114, 0.587, 0.299)
+
+
+class BatchCompose(object):
+    """Composes several batch augmentations together."""
+
+    def __init__(self, transforms):
+        self.transforms = transforms
+
+    def __call__(self, images, targets):
+        for t in self.transforms:
+            images, targets = t(images, targets)
+        return images, targets
+
+
+def random_mask(batch_size, probability, device):
+    # Per-sample mask of the samples to which a transform is applied.
+    return torch.rand(batch_size, device=device) < probability
+
+
+def random_uniform(batch_size, lower, upper, device):
+    return lower + (upper - lower) * torch.rand(batch_size, device=device)
+
+
+class BatchRandomBrightness(object):
+    def __init__(self, delta=32):
+        assert 0.0 <= delta <= 255.0
+        self.delta = delta
+
+    def __call__(self, images, targets):
+        B = images.size(0)
+        delta = random_uniform(B, -self.delta, self.delta, images.device)
+        delta *= random_mask(B, 0.5, images.device).float()
+        images += delta.view(B, 1, 1, 1)
+        return images, targets
+
+
+class BatchRandomContrast(object):
+    def __init__(self, lower=0.5, upper=1.5):
+        assert upper >= lower, "contrast upper must be >= lower."
+        assert lower >= 0, "contrast lower must be non-negative."
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images, targets):
+        B = images.size(0)
+        alpha = random_uniform(B, self.lower, self.upper, images.device)
+        alpha[~random_mask(B, 0.5, images.device)] = 1
+        images *= alpha.view(B, 1, 1, 1)
+        return images, targets
+
+
+class BatchRandomSaturation(object):
+    """Scale the saturation by blending each image with its luminance."""
+
+    def __init__(self, lower=0.5, upper=1.5):
+        assert upper >= lower, "saturation upper must be >= lower."
+        assert lower >= 0, "saturation lower must be non-negative."
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images, targets):
+        B = images.size(0)
+        scale = random_uniform(B, self.lower, self.upper, images.device)
+        scale[~random_mask(B, 0.5, images.device)] = 1
+        luminance = (images * images.new_tensor(BGR_LUMINANCE).view(1, 3, 1, 1)).sum(1, keepdim=True)
+        images = luminance + scale.view(B, 1, 1, 1) * (images - luminance)
+        return images, targets
+
+
+class BatchRandomHue(object):
+    """Shift the hue by rotating the chrominance of each image in the YIQ color space."""
+
+    def __init__(self, delta=18.0):
+        assert 0.0 <= delta <= 360.0
+        self.delta = delta
+        # Conversion matrices between BGR and YIQ.
+        rgb_to_yiq = torch.Tensor([[0.299, 0.587, 0.114],
+                                   [0.596, -0.274, -0.322],
+                                   [0.211, -0.523, 0.312]])
+        self.bgr_to_yiq = rgb_to_yiq[:, (2, 1, 0)]
+        self.yiq_to_bgr = torch.inverse(self.bgr_to_yiq)
+
+    def __call__(self, images, targets):
+        B = images.size(0)
+        angle = random_uniform(B, -self.delta, self.delta, images.device) * math.pi / 180
+        angle[~random_mask(B, 0.5, images.device)] = 0
+        rotation = torch.zeros(B, 3, 3, device=images.device)
+        rotation[:, 0, 0] = 1
+        rotation[:, 1, 1] = torch.cos(angle)
+        rotation[:, 1, 2] = -torch.sin(angle)
+        rotation[:, 2, 1] = torch.sin(angle)
+        rotation[:, 2, 2] = torch.cos(angle)
+        transform = self.yiq_to_bgr.to(images.device) @ rotation @ self.bgr_to_yiq.to(images.device)
+        images = torch.bmm(transform, images.view(B, 3, -1)).view_as(images)
+        return images, targets
+
+
+class BatchRandomLightingNoise(object):
+    """Randomly permute the color channels of each image."""
+
+    def __init__(self):
+        self.perms = torch.LongTensor([(0, 1, 2), (0, 2, 1),
+                                       (1, 0, 2), (1, 2, 0),
+                                       (2, 0, 1), (2, 1, 0)])
+
+    def __call__(self, images, targets):
+        B, C, H, W = images.size()
+        perms = self.perms.to(images.device)[torch.randint(len(self.perms), (B,), device=images.device)]
+        perms[~random_mask(B, 0.5, images.device)] = perms.new_tensor((0, 1, 2))
+        images = images.gather(1, perms.view(B, C, 1, 1).expand(B, C, H, W))
+        return images, targets
+
+
+class BatchPhotometricDistort(object):
+    def __init__(self):
+        self.rand_brightness = BatchRandomBrightness()
+        self.rand_contrast = BatchRandomContrast()
+        self.distort = BatchCompose([
+            BatchRandomSaturation(),
+            BatchRandomHue()
+        ])
+        self.rand_light_noise = BatchRandomLightingNoise()
+
+    def __call__(self, images, targets):
+        images, targets = self.rand_brightness(images, targets)
+        # Apply the contrast either before or after the color distortions.
+        B = images.size(0)
+        contrast_first = random_mask(B, 0.5, images.device).view(B, 1, 1, 1)
+        contrasted, _ = self.rand_contrast(images.clone(), targets)
+        images = torch.where(contrast_first, contrasted, images)
+        images, targets = self.distort(images, targets)
+        contrasted, _ = self.rand_contrast(images.clone(), targets)
+        images = torch.where(contrast_first, images, contrasted)
+        return self.rand_light_noise(images, targets)
+
+
+class BatchRandomMirror(object):
+    def __call__(self, images, targets):
+        mirror = random_mask(images.size(0), 0.5, images.device)
+        images = torch.where(mirror.view(-1, 1, 1, 1), images.flip(3), images)
+        targets = [self.mirror_boxes(t) if m else t for t, m in zip(targets, mirror.tolist())]
+        return images, targets
+
+    @staticmethod
+    def mirror_boxes(targets):
+        # Boxes are in percent coordinates: (xmin, ymin, xmax, ymax, class).
+        targets = targets.clone()
+        targets[:, (0, 2)] = 1 - targets[:, (2, 0)]
+        return targets
+
+
+class BatchRandomRotation(object):
+    """Rotate each image by a random multiple of 90 degrees. Images must be square."""
+
+    def __call__(self, images, targets):
+        B = images.size(0)
+        turns = torch.randint(4, (B,), device=images.device)
+        rotated = images.clone()
+        for k in range(1, 4):
+            idx = (turns == k).nonzero().view(-1)
+            if idx.numel():
+                rotated[idx] = torch.rot90(images[idx], k, dims=(2, 3))
+        targets = [self.rotate_boxes(t, k) for t, k in zip(targets, turns.tolist())]
+        return rotated, targets
+
+    @staticmethod
+    def rotate_boxes(targets, turns):
+        # torch.rot90 maps the point (x, y) to (y, 1 - x) in percent coordinates.
+        for _ in range(turns):
+            targets = targets.clone()
+            targets[:, :4] = torch.stack((targets[:, 1], 1 - targets[:, 2], targets[:, 3], 1 - targets[:, 0]), 1)
+        return targets
+
+
+class BatchSinusoidalIntensityFluctuation(object):
+    def __init__(self, size, amplitude=0.25):
+        height, width = size
+        self.amplitude = amplitude
+        self.ymesh, self.xmesh = torch.meshgrid(torch.linspace(0., 1., height), torch.linspace(0., 1., width),
+                                                indexing='ij')
+
+    def __call__(self, images, targets):
+        # Determine the property of the wave of each image: (orientation, frequency, amplitude).
+        B = images.size(0)
+        angle = random_uniform(B, 0, 2 * math.pi, images.device).view(B, 1, 1)
+        frequency = 1 / random_uniform(B, 0.1, 0.5, images.device).view(B, 1, 1)
+        xmesh = self.xmesh.to(images.device)
+        ymesh = self.ymesh.to(images.device)
+
+        # Generate the masks based upon the 2d sin waves.
+        phase = 2 * math.pi * frequency * (torch.cos(angle) * xmesh + torch.sin(angle) * ymesh)
+        mask = 1 - self.amplitude + self.amplitude * torch.cos(phase)
+        images = (images * mask.unsqueeze(1)).floor()
+        return images, targets
+
+
+class BatchSubtractMeans(object):
+    def __init__(self, mean):
+        self.mean = torch.Tensor(mean).view(1, -1, 1, 1)
+
+    def __call__(self, images, targets):
+        return images - self.mean.to(images.device), targets
+
+
+class BatchTreeAugmentation(object):
+    """Batched counterpart of TreeAugmentation.
+
+    Called on a single sample, as the dataset transform, it only resizes the image and converts the boxes to percent
+    coordinates, so that DataLoader workers only decode the images. The random augmentations are then applied with
+    per-sample parameters to the collated batch by augment_batch, e.g. on the training device.
+    """
+
+    def __init__(self, size=300, mean=(104, 117, 123)):
+        self.mean = mean
+        self.size = size
+        self.prepare = Compose([
+            ToPercentCoords(),
+            Resize(self.size)
+        ])
+        self.augment = BatchCompose([
+            BatchPhotometricDistort(),
+            BatchRandomMirror(),
+            BatchRandomRotation(),
+            BatchSinusoidalIntensityFluctuation((self.size, self.size)),
+            BatchSubtractMeans(self.mean)
+        ])
+
+    def __call__(self, img, boxes, labels):
+        return self.prepare(img, boxes, labels)
+
+    def augment_batch(self, images, targets):
+        """
+        Augment a collated batch.
+        :param images: (tensor) batch of images, Shape: [batch,C,size,size]
+        :param targets: (list of tensors) objects of each image in (xmin, ymin, xmax, ymax, class) percent coordinates
+        :return: augmented float images and targets
+        """
+        return self.augment(images.to(torch.float32, copy=True), targets)
@@ -0,0 +1,248 @@
+# Benchmarks of the training and inference routines.
+import argparse
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from layers.modules import MultiBoxLoss
+from utils.evaluation import match_detections, match_image_detections
+from utils.precision import autocast
+from data.config import get_default_configs, build_config
+from ssd import build_ssd
+from utils.export import export_torchscript, load_torchscript
+
+# Number of priors of SSD300.
+NUM_PRIORS = 8732
+
+
+def time_function(function, N_repeats=10, N_warmup=2):
+    # Average run time of a function in seconds.
+    for _ in range(N_warmup):
+        function()
+    start = time.perf_counter()
+    for _ in range(N_repeats):
+        function()
+    return (time.perf_counter() - start) / N_repeats
+
+
+def random_loss_inputs(batch_size, num_classes, N_objects=10, num_priors=NUM_PRIORS):
+    # Random predictions, priors (center-size form) and ground truths (percent coordinates) of a batch.
+    loc_data = torch.randn(batch_size, num_priors, 4)
+    conf_data = torch.randn(batch_size, num_priors, num_classes)
+    priors = torch.cat((torch.rand(num_priors, 2), 0.05 + 0.3 * torch.rand(num_priors, 2)), 1)
+    targets = []
+    for _ in range(batch_size):
+        corners = torch.rand(N_objects, 2) * 0.8
+        sizes = 0.05 + 0.15 * torch.rand(N_objects, 2)
+        labels = torch.randint(num_classes - 1, (N_objects, 1)).float()
+        targets.append(torch.cat((corners, corners + sizes, labels), 1))
+    return (loc_data, conf_data, priors), targets
+
+
+def benchmark_hard_negative_mining(batch_sizes=(4, 8, 16, 32, 64), num_classes=3, N_repeats=10):
+    """Compare the run time of the multibox loss with the 'sort' and 'topk' hard negative mining."""
+    config = SimpleNamespace(num_classes=num_classes, prior_box_variance=[0.1, 0.2])
+    criteria = {mode: MultiBoxLoss(config, 0.5, True, 0, True, 3, 0.5, False, False, mode)
+                for mode in ('sort', 'topk')}
+    print('{:>10s} {:>12s} {:>12s} {:>8s}'.format('batch size', 'sort (ms)', 'topk (ms)', 'speedup'))
+    for batch_size in batch_sizes:
+        predictions, targets = random_loss_inputs(batch_size, num_classes)
+        losses = {mode: criterion(predictions, targets) for mode, criterion in criteria.items()}
+        if not all(torch.allclose(x, y) for x, y in zip(losses['sort'], losses['topk'])):
+            print('WARNING: The sort and topk losses differ for a batch size of {:d}.'.format(batch_size))
+        with torch.no_grad():
+            times = {mode: time_function(lambda: criterion(predictions, targets), N_repeats)
+                     for mode, criterion in criteria.items()}
+        print('{:>10d} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(batch_size, 1000 * times['sort'], 1000 * times['topk'],
+                                                             times['sort'] / times['topk']))
+
+
+def random_evaluation_inputs(num_images, max_objects=20, image_size=300, seed=0):
+    """Random ground truths of one class and detections scattered around them, as in evaluate_detections.
+
+    Return:
+        gt boxes, gt image ids, detection boxes, detection image ids and detection scores. Boxes are in
+        (xmin, xmax, ymin, ymax) pixel format.
+    """
+    rng = np.random.RandomState(seed)
+    N_gts = rng.randint(0, max_objects + 1, num_images)
+    N_dets = rng.randint(0, 2 * max_objects + 1, num_images)
+    gt_image_ids = np.repeat(np.arange(num_images), N_gts)
+    det_image_ids = np.repeat(np.arange(num_images), N_dets)
+
+    def random_boxes(N):
+        corners = rng.uniform(0, image_size - 30, (N, 2))
+        sizes = rng.uniform(10, 30, (N, 2))
+        return np.round(np.column_stack((corners[:, 0], corners[:, 0] + sizes[:, 0],
+                                         corners[:, 1], corners[:, 1] + sizes[:, 1])))
+
+    # Half of the detections are jittered copies of a ground truth of their image.
+    gt_boxes = random_boxes(len(gt_image_ids))
+    det_boxes = random_boxes(len(det_image_ids))
+    gt_offsets = np.cumsum(N_gts) - N_gts
+    copies = (rng.rand(len(det_image_ids)) < 0.5) & (N_gts[det_image_ids] > 0)
+    copied_gt = gt_offsets[det_image_ids] + (rng.rand(len(det_image_ids)) * N_gts[det_image_ids]).astype(int)
+    det_boxes[copies] = gt_boxes[copied_gt[copies]] + rng.randint(-4, 5, (copies.sum(), 4))
+    det_scores = np.round(rng.rand(len(det_image_ids)), 2).astype(np.float32)
+    return gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores
+
+
+def benchmark_evaluation(num_images=10000, N_repeats=3):
+    """Compare the run time of the vectorized detection matching with the loop over the images."""
+    gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores = random_evaluation_inputs(num_images)
+    gt_offsets = np.searchsorted(gt_image_ids, np.arange(num_images + 1))
+    det_offsets = np.searchsorted(det_image_ids, np.arange(num_images + 1))
+
+    def loop():
+        return [match_image_detections(gt_boxes[gt_offsets[i]:gt_offsets[i + 1]],
+                                       det_boxes[det_offsets[i]:det_offsets[i + 1]],
+                                       det_scores[det_offsets[i]:det_offsets[i + 1]]) for i in range(num_images)]
+
+    def vectorized():
+        return match_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores, num_images)
+
+    counts = np.array([x[:3] for x in loop()], dtype=float).T
+    if not np.array_equal(counts, np.array(vectorized()[:3])):
+        print('WARNING: The vectorized and loop counts differ.')
+    loop_time = time_function(loop, N_repeats, N_warmup=0)
+    vectorized_time = time_function(vectorized, N_repeats, N_warmup=1)
+    print('{:d} images, {:d} ground truths, {:d} detections'.format(num_images, len(gt_boxes), len(det_boxes)))
+    print('loop: {:.3f}s, vectorized: {:.3f}s, speedup: {:.1f}x'.format(loop_time, vectorized_time,
+                                                                        loop_time / vectorized_time))
+
+
+def benchmark_precision(batch_size=8, precisions=('fp32', 'bf16'), N_repeats=3):
+    """Compare the training and inference throughput of SSD300 on the CPU in each precision."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs_dict = get_default_configs()
+        configs_dict['dataset_dir'] = tmp_dir
+        config = build_config(configs_dict).model
+    torch.manual_seed(0)
+    train_net = build_ssd('train', config)
+    test_net = build_ssd('test', config)
+    test_net.eval()
+    criterion = MultiBoxLoss(config, 0.5, True, 0, True, 3, 0.5, False, False)
+    optimizer = torch.optim.SGD(train_net.parameters(), lr=1e-6, momentum=0.9)
+    images = 255 * torch.rand(batch_size, 3, config.input_size, config.input_size)
+    _, targets = random_loss_inputs(batch_size, config.num_classes)
+
+    def train_step(precision):
+        with autocast(precision):
+            predictions = train_net(images)
+        loss_l, loss_c = criterion(predictions, targets)
+        optimizer.zero_grad()
+        (loss_l + loss_c).backward()
+        optimizer.step()
+
+    def inference(precision):
+        with torch.no_grad(), autocast(precision):
+            test_net(images)
+
+    print('{:>10s} {:>18s} {:>22s}'.format('precision', 'train (images/s)', 'inference (images/s)'))
+    throughputs = {}
+    for precision in precisions:
+        throughputs[precision] = (batch_size / time_function(lambda: train_step(precision), N_repeats, 1),
+                                  batch_size / time_function(lambda: inference(precision), N_repeats, 1))
+        print('{:>10s} {:>18.2f} {:>22.2f}'.format(precision, *throughputs[precision]))
+    for precision in precisions[1:]:
+        print('{} speedup: train {:.2f}x, inference {:.2f}x'.format(
+            precision, throughputs[precision][0] / throughputs[precisions[0]][0],
+            throughputs[precision][1] / throughputs[precisions[0]][1]))
+
+
+def benchmark_build_mode(batch_size=8, N_repeats=5):
+    """Compare the forward latency of SSD300 on the CPU in each build mode.
+
+    The optimized build keeps the activations in channels_last memory format. The last row exports the optimized
+    network with export_torchscript and loads it with load_torchscript, which fuses each convolution with its ReLU
+    activation, as when eval_model_format is 'torchscript'.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs_dict = get_default_configs()
+        configs_dict['dataset_dir'] = tmp_dir
+        configs = build_config(configs_dict)
+        torch.manual_seed(0)
+        images = 255 * torch.rand(batch_size, 3, configs.model.input_size, configs.model.input_size)
+
+        networks = {}
+        for build_mode in ('default', 'optimized'):
+            configs.model.build_mode = build_mode
+            net = build_ssd('test', configs.model)
+            net.eval()
+            networks[build_mode] = net
+        filepath = os.path.join(tmp_dir, 'ssd.ts.pt')
+        export_torchscript(networks['optimized'], filepath)
+        networks['optimized + fused conv+ReLU'] = load_torchscript(filepath)
+
+    print('{:>28s} {:>22s} {:>8s}'.format('build mode', 'latency (ms/image)', 'speedup'))
+    latencies = {}
+    for name, net in networks.items():
+        # The fusion groups are compiled during the first two calls.
+        with torch.no_grad():
+            latencies[name] = 1000 * time_function(lambda: net(images), N_repeats, 3) / batch_size
+        print('{:>28s} {:>22.1f} {:>7.2f}x'.format(name, latencies[name], latencies['default'] / latencies[name]))
+
+
+def benchmark_input_size(batch_size=4, input_sizes=(300, 512, 640, 1024), N_repeats=3):
+    """Compare the number of priors and the forward latency of SSD on the CPU at each input size."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs_dict = get_default_configs()
+        configs_dict['dataset_dir'] = tmp_dir
+        configs = build_config(configs_dict)
+    torch.manual_seed(0)
+
+    print('{:>10s} {:>10s} {:>22s}'.format('input size', 'priors', 'latency (ms/image)'))
+    for input_size in input_sizes:
+        configs.model.input_size = input_size
+        net = build_ssd('test', configs.model)
+        net.eval()
+        images = 255 * torch.rand(batch_size, 3, input_size, input_size)
+        with torch.no_grad():
+            latency = 1000 * time_function(lambda: net(images), N_repeats, 1) / batch_size
+        print('{:>10d} {:>10d} {:>22.1f}'.format(input_size, net.priors.size(0), latency))
+
+
+def benchmark_base_network(batch_size=8, base_networks=('vgg16', 'mobilenet'), N_repeats=3):
+    """Compare the inference throughput of SSD300 on the CPU with each base network.
+
+    The networks have random weights. To compare the precision/recall of trained networks, run compare.py.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        configs_dict = get_default_configs()
+        configs_dict['dataset_dir'] = tmp_dir
+        configs = build_config(configs_dict)
+    torch.manual_seed(0)
+    images = 255 * torch.rand(batch_size, 3, configs.model.input_size, configs.model.input_size)
+
+    print('{:>12s} {:>12s} {:>22s}'.format('base network', 'parameters', 'inference (images/s)'))
+    throughputs = {}
+    for base_network in base_networks:
+        configs.model.basenet = base_network
+        net = build_ssd('test', configs.model)
+        net.eval()
+        with torch.no_grad():
+            throughputs[base_network] = batch_size / time_function(lambda: net(images), N_repeats, 1)
+        print('{:>12s} {:>11.1f}M {:>22.2f}'.format(base_network, sum(p.numel() for p in net.parameters()) / 1e6,
+                                                   throughputs[base_network]))
+    for base_network in base_networks[1:]:
+        print('{} speedup: {:.2f}x'.format(base_network, throughputs[base_network] / throughputs[base_networks[0]]))
+
+
+BENCHMARKS = {
+    'hard_negative_mining': benchmark_hard_negative_mining,
+    'evaluation': benchmark_evaluation,
+    'precision': benchmark_precision,
+    'build_mode': benchmark_build_mode,
+    'input_size': benchmark_input_size,
+    'base_network': benchmark_base_network,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the SSD routines.')
+    parser.add_argument('benchmark', type=str, choices=list(BENCHMARKS.keys()),
+                        help='Name of the benchmark to run')
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark]()
@@ -0,0 +1,109 @@
+# Columnar storage of the detections of a dataset.
+import numpy as np
+
+
+class DetectionStore(object):
+    """Detections of all images of a dataset stored as flat columns.
+
+    Rows are grouped by image, so that the detections of image i are the rows offsets[i]:offsets[i + 1]. Within an
+    image, rows keep the order in which they were added, i.e. by class and decreasing score for the SSD detections.
+
+    Arguments:
+        image_ids (np.array): image index of each detection, Shape: [N]
+        classes (np.array): network class of each detection (0 is the background), Shape: [N]
+        scores (np.array): confidence of each detection, Shape: [N]
+        boxes (np.array): box limits (xmin, xmax, ymin, ymax) in pixels of each detection, Shape: [N,4]
+        offsets (np.array): first row of each image, Shape: [N_images + 1]
+    """
+
+    def __init__(self, image_ids, classes, scores, boxes, offsets):
+        self.image_ids = image_ids
+        self.classes = classes
+        self.scores = scores
+        self.boxes = boxes
+        self.offsets = offsets
+
+    @property
+    def num_images(self):
+        return len(self.offsets) - 1
+
+    def __len__(self):
+        return len(self.scores)
+
+    def select(self, image=None, class_id=None, min_score=None):
+        """
+        Find the detections of an image and/or a class above a confidence threshold.
+        :param image: image index. All images are searched if None.
+        :param class_id: network class. All classes are searched if None.
+        :param min_score: detections with a confidence strictly above min_score are kept. All kept if None.
+        :return: (np.array) rows of the selected detections, in increasing order.
+        """
+        if image is None:
+            start, end = 0, len(self)
+        else:
+            start, end = int(self.offsets[image]), int(self.offsets[image + 1])
+        mask = np.ones(end - start, dtype=bool)
+        if class_id is not None:
+            mask &= self.classes[start:end] == class_id
+        if min_score is not None:
+            mask &= self.scores[start:end] > min_score
+        return start + np.flatnonzero(mask)
+
+    def detections(self, image, class_id, min_score=None):
+        """
+        Detections of a class in an image.
+        :return: (np.array) box limits (xmin, xmax, ymin, ymax) and score of each detection, Shape: [N,5]
+        """
+        rows = self.select(image, class_id, min_score)
+        return np.column_stack((self.boxes[rows], self.scores[rows]))
+
+    def save(self, filepath):
+        np.savez(filepath, image_ids=self.image_ids, classes=self.classes, scores=self.scores, boxes=self.boxes,
+                 offsets=self.offsets)
+
+    @classmethod
+    def load(cls, filepath):
+        store = np.load(filepath)
+        return cls(store['image_ids'], store['classes'], store['scores'], store['boxes'], store['offsets'])
+
+
+class DetectionStoreBuilder(object):
+    """Collect the detections of each image and build a DetectionStore.
+
+    Arguments:
+        num_images (int): number of images of the dataset.
+    """
+
+    def __init__(self, num_images):
+        self.num_images = num_images
+        self.image_ids = []
+        self.classes = []
+        self.scores = []
+        self.boxes = []
+
+    def append(self, image, classes, scores, boxes):
+        """
+        Add the detections of an image.
+        :param image: image index.
+        :param classes: (np.array) network class of each detection, Shape: [N]
+        :param scores: (np.array) confidence of each detection, Shape: [N]
+        :param boxes: (np.array) box limits (xmin, xmax, ymin, ymax) in pixels, Shape: [N,4]
+        """
+        self.image_ids.append(np.full(len(scores), image, dtype=np.int32))
+        self.classes.append(np.asarray(classes, dtype=np.int16))
+        self.scores.append(np.asarray(scores, dtype=np.float32))
+        self.boxes.append(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))
+
+    def build(self):
+        if not self.scores:
+            return DetectionStore(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int16),
+                                  np.zeros(0, dtype=np.float32), np.zeros((0, 4), dtype=np.float32),
+                                  np.zeros(self.num_images + 1, dtype=np.int64))
+
+        # Group the rows by image, keeping the order of the rows of each image.
+        image_ids = np.concatenate(self.image_ids)
+        order = np.argsort(image_ids, kind='stable')
+        offsets = np.zeros(self.num_images + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(image_ids, minlength=self.num_images))
+        return DetectionStore(image_ids[order], np.concatenate(self.classes)[order],
+                              np.concatenate(self.scores)[order], np.concatenate(self.boxes)[order], offsets)
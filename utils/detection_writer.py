@@ -0,0 +1,114 @@
+# Background writing of the detection results.
+import queue
+import threading
+
+import numpy as np
+import torch
+
+# Columns of the detections array of an image.
+DETECTION_COLUMNS = ('xmin', 'xmax', 'ymin', 'ymax', 'class', 'class_score')
+
+
+def scale_detections(dets, w, h):
+    """Keep the detections of one class with a positive score and scale the boxes dimensions to the image size.
+    :param dets: detections of the network for one class in (score, xmin, ymin, xmax, ymax) format. Shape: [top_k,5]
+    :return: detections with boxes in pixels.
+    """
+    mask = dets[:, 0].gt(0.).expand(5, dets.size(0)).t()
+    dets = torch.masked_select(dets, mask).view(-1, 5)
+    dets[:, (1, 3)] *= w
+    dets[:, (2, 4)] *= h
+    return dets
+
+
+def gather_detections(image_detections):
+    """Concatenate the detections of all classes of an image. Skip j = 0 (background class).
+    :param image_detections: list indexed by class of detections (score, xmin, ymin, xmax, ymax) in pixels.
+    :return: class type (0 for the first object class), score and box limits (xmin, xmax, ymin, ymax) of each
+    detection.
+    """
+    dets = torch.cat([d.view(-1, 5) for d in image_detections[1:]]).cpu().numpy()
+    N_detections = [len(d) for d in image_detections[1:]]
+    class_type = np.repeat(np.arange(len(N_detections)), N_detections)
+    box_limits = np.round(dets[:, (1, 3, 2, 4)])
+    scores = dets[:, 0]
+    return class_type, scores, box_limits
+
+
+def format_detections_csv(detections, column_names):
+    """
+    Format the detections of an image as CSV text with a single formatting operation.
+    :param detections: (np.array) detections in (xmin, xmax, ymin, ymax, class, class_score) format, Shape: [N,6]
+    :param column_names: names of the CSV columns, in any order of DETECTION_COLUMNS.
+    :return: CSV text, including the header.
+    """
+    order = [DETECTION_COLUMNS.index(name) for name in column_names]
+    # The boxes limits are saved as uint16 and the classes as uint8.
+    columns = [detections[:, :4].astype(np.uint16), detections[:, 4:5].astype(np.uint8), detections[:, 5:6]]
+    values = np.hstack(columns).astype(object)[:, order]
+    # The scores are written with repr, as the csv module did, so that the files keep their full precision.
+    formats = ['%d'] * 5 + ['%r']
+    row_format = ','.join(formats[k] for k in order) + '\r\n'
+    return ','.join(column_names) + '\r\n' + (row_format * len(values)) % tuple(values.ravel().tolist())
+
+
+class DetectionWriter(threading.Thread):
+    """Thread writing the detections CSV of each image.
+
+    Detections are passed through a bounded queue, so that the inference loop only blocks when the disk falls behind
+    by more than max_queue_size images. Errors raised while writing are raised again by close().
+
+    Arguments:
+        column_names (list): names of the CSV columns.
+        max_queue_size (int): maximum number of images waiting to be written.
+    """
+
+    def __init__(self, column_names, max_queue_size=64):
+        super(DetectionWriter, self).__init__(daemon=True)
+        self.column_names = list(column_names)
+        self.queue = queue.Queue(max_queue_size)
+        self.error = None
+        self.start()
+
+    def put(self, filepath, detections, on_written=None):
+        """
+        Queue the detections of an image.
+        :param filepath: path of the CSV file.
+        :param detections: (np.array) detections in (xmin, xmax, ymin, ymax, class, class_score) format, Shape: [N,6]
+        :param on_written: function called by the writer thread once the CSV file is written.
+        """
+        if self.error is not None:
+            self.close()
+        self.queue.put((filepath, detections, on_written))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue
+            filepath, detections, on_written = item
+            try:
+                text = format_detections_csv(detections, self.column_names)
+                with open(filepath, 'w', newline='') as csvfile:
+                    csvfile.write(text)
+                if on_written is not None:
+                    on_written()
+            except Exception as error:
+                self.error = error
+
+    def close(self):
+        # Wait until all the queued detections are written.
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
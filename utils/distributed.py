@@ -0,0 +1,71 @@
+# Helpers of the multi-process CPU training with torch.distributed.
+import glob
+import os
+import os.path as osp
+
+import torch
+import torch.distributed as dist
+
+
+def parse_cpulist(cpulist):
+    # Convert a Linux cpu list, e.g. '0-3,8-11', to a list of cpu ids.
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+
+def numa_node_cpus():
+    """List of the available cpus of each NUMA node of the machine. A single node is returned if the topology is
+    unknown."""
+    cpus = set(available_cpus())
+    nodes = []
+    for node_dir in sorted(glob.glob('/sys/devices/system/node/node[0-9]*')):
+        with open(osp.join(node_dir, 'cpulist')) as file:
+            node_cpus = [cpu for cpu in parse_cpulist(file.read()) if cpu in cpus]
+        if node_cpus:
+            nodes.append(node_cpus)
+    return nodes or [sorted(cpus)]
+
+
+def process_cpus(local_rank, procs_per_node):
+    # One process per NUMA node keeps the memory accesses local. Otherwise, the cpus are split evenly.
+    nodes = numa_node_cpus()
+    if len(nodes) == procs_per_node:
+        return nodes[local_rank]
+    cpus = [cpu for node in nodes for cpu in node]
+    chunk = max(len(cpus) // procs_per_node, 1)
+    return cpus[(local_rank * chunk) % len(cpus):][:chunk]
+
+
+def init_process(local_rank, procs_per_node, num_nodes, node_rank, dist_url):
+    """
+    Pin a training process to its cpus and join the gloo process group.
+    :param local_rank: rank of the process on its machine.
+    :param procs_per_node: number of processes per machine.
+    :param num_nodes: number of machines.
+    :param node_rank: rank of the machine.
+    :param dist_url: address of the rank 0 process, e.g. tcp://192.168.0.1:23456
+    :return: (rank, world_size)
+    """
+    cpus = process_cpus(local_rank, procs_per_node)
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+
+    rank = node_rank * procs_per_node + local_rank
+    world_size = num_nodes * procs_per_node
+    dist.init_process_group('gloo', init_method=dist_url, rank=rank, world_size=world_size)
+    return rank, world_size
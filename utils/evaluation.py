@@ -0,0 +1,292 @@
+# Matching of the detections with the ground truths.
+import numpy as np
+import torch
+from layers.box_utils import jaccard
+
+# Confidence thresholds at which the precision-recall curves are reported.
+CONFIDENCE_THRESHOLDS = np.round(np.linspace(0, 1, 101), 2)
+
+
+def to_point_form(boxes):
+    # Convert box limits (xmin, xmax, ymin, ymax) to the (xmin, ymin, xmax, ymax) format of jaccard.
+    return torch.Tensor(np.asarray(boxes, dtype=np.float32).reshape(-1, 4))[:, (0, 2, 1, 3)]
+
+
+def assign_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids, num_images):
+    """Assign each detection to the ground truth of its image with the highest jaccard overlap.
+
+    Args:
+        gt_boxes: (np.array) ground truth box limits (xmin, xmax, ymin, ymax), grouped by image, Shape: [G,4]
+        gt_image_ids: (np.array) image index of each ground truth, in increasing order, Shape: [G]
+        det_boxes: (np.array) detection box limits (xmin, xmax, ymin, ymax), Shape: [D,4]
+        det_image_ids: (np.array) image index of each detection, Shape: [D]
+        num_images: (int) number of images.
+    Return:
+        best jaccard overlap and index of the assigned ground truth of each detection, Shape: [D]. Detections of
+        images without ground truths have an overlap of -1 and the index G. Ties are resolved in favor of the first
+        ground truth.
+    """
+    gt_boxes = to_point_form(gt_boxes)
+    det_boxes = to_point_form(det_boxes)
+    gt_image_ids = torch.as_tensor(np.asarray(gt_image_ids), dtype=torch.long)
+    det_image_ids = torch.as_tensor(np.asarray(det_image_ids), dtype=torch.long)
+    N_gts = torch.bincount(gt_image_ids, minlength=num_images)
+    G, D = len(gt_boxes), len(det_boxes)
+
+    # Pair each detection with every ground truth of its image.
+    gt_offsets = torch.cumsum(N_gts, 0) - N_gts
+    pairs_per_det = N_gts[det_image_ids]
+    det_idx = torch.repeat_interleave(torch.arange(D), pairs_per_det)
+    pair_start = torch.cumsum(pairs_per_det, 0) - pairs_per_det
+    gt_idx = gt_offsets[det_image_ids[det_idx]] + torch.arange(len(det_idx)) - pair_start[det_idx]
+    overlaps = jaccard(gt_boxes[gt_idx].unsqueeze(1), det_boxes[det_idx].unsqueeze(1)).view(-1)
+
+    # For each detection, find the best ground truth overlap.
+    best_truth_jaccard = overlaps.new_full((D,), -1).scatter_reduce(0, det_idx, overlaps, 'amax')
+    is_best = overlaps == best_truth_jaccard[det_idx]
+    best_truth_idx = torch.full((D,), G, dtype=torch.long).scatter_reduce(0, det_idx[is_best], gt_idx[is_best],
+                                                                        'amin')
+    return best_truth_jaccard, best_truth_idx
+
+
+def match_assigned_detections(best_truth_jaccard, best_truth_idx, det_scores, N_gts, min_jaccard_overlap=0.5):
+    """Match each ground truth to its assigned detection of highest confidence.
+
+    Only the detections with an overlap above min_jaccard_overlap are matched. Ties are resolved in favor of the first
+    detection.
+    Return:
+        (tensor) index of the detection matched to each ground truth, or D if the ground truth is not matched,
+        Shape: [N_gts]
+    """
+    det_scores = torch.as_tensor(np.asarray(det_scores, dtype=np.float32))
+    D = len(det_scores)
+    candidates = ((best_truth_jaccard > min_jaccard_overlap) & (det_scores > 0)).nonzero().view(-1)
+    candidates_gt = best_truth_idx[candidates]
+    best_detection_conf = det_scores.new_zeros(N_gts).scatter_reduce(0, candidates_gt, det_scores[candidates],
+                                                                     'amax')
+    is_best = det_scores[candidates] == best_detection_conf[candidates_gt]
+    return torch.full((N_gts,), D, dtype=torch.long).scatter_reduce(0, candidates_gt[is_best], candidates[is_best],
+                                                                    'amin')
+
+
+def match_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores, num_images,
+                     min_jaccard_overlap=0.5):
+    """Count the true positives, false positives and false negatives of one class in all images at once.
+
+    Each detection is assigned to the ground truth of its image with the highest jaccard overlap. Each ground truth is
+    then matched to the assigned detection of highest confidence, among those with an overlap above
+    min_jaccard_overlap. Ties are resolved in favor of the first ground truth and the first detection of the image.
+
+    Args:
+        gt_boxes: (np.array) ground truth box limits (xmin, xmax, ymin, ymax), grouped by image, Shape: [G,4]
+        gt_image_ids: (np.array) image index of each ground truth, in increasing order, Shape: [G]
+        det_boxes: (np.array) detection box limits (xmin, xmax, ymin, ymax), Shape: [D,4]
+        det_image_ids: (np.array) image index of each detection, Shape: [D]
+        det_scores: (np.array) confidence of each detection, Shape: [D]
+        num_images: (int) number of images.
+        min_jaccard_overlap: (float) minimum jaccard overlap of a true positive.
+    Return:
+        true positives, false positives, false negatives and mean jaccard overlap of the true positives of each image,
+        Shape: [num_images]. The mean overlap is 0 if the image has no ground truths or no detections and nan if it
+        has no true positives.
+    """
+    best_truth_jaccard, best_truth_idx = assign_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids,
+                                                           num_images)
+    best_detection_idx = match_assigned_detections(best_truth_jaccard, best_truth_idx, det_scores, len(gt_image_ids),
+                                                   min_jaccard_overlap)
+    matched = best_detection_idx < len(det_scores)
+
+    # Count the true positives of each image and average their overlap.
+    gt_image_ids = torch.as_tensor(np.asarray(gt_image_ids), dtype=torch.long)
+    N_gts = torch.bincount(gt_image_ids, minlength=num_images)
+    N_dets = torch.bincount(torch.as_tensor(np.asarray(det_image_ids), dtype=torch.long), minlength=num_images)
+    true_pos = torch.bincount(gt_image_ids[matched], minlength=num_images)
+    jaccard_sum = torch.zeros(num_images, dtype=torch.float64).index_add_(
+        0, gt_image_ids[matched], best_truth_jaccard[best_detection_idx[matched]].double())
+    truepos_jaccard_mean = jaccard_sum / true_pos.double()
+    truepos_jaccard_mean[(N_gts == 0) | (N_dets == 0)] = 0
+
+    true_pos = true_pos.numpy().astype(float)
+    false_pos = N_dets.numpy() - true_pos
+    false_neg = N_gts.numpy() - true_pos
+    return true_pos, false_pos, false_neg, truepos_jaccard_mean.numpy()
+
+
+def precision_recall_sweep(gt_boxes, gt_image_ids, det_boxes, det_image_ids, det_scores, num_images,
+                           iou_thresholds, confidence_thresholds=CONFIDENCE_THRESHOLDS):
+    """Precision, recall and F1 score of one class for a sweep of confidence and jaccard overlap thresholds.
+
+    The detections are matched once per overlap threshold as in match_detections. Since the matched detection of a
+    ground truth is the one of highest confidence, the true positives above any confidence threshold are found from
+    the cumulative sum of the matches sorted by decreasing confidence.
+    Args:
+        iou_thresholds: list of minimum jaccard overlaps of a true positive.
+        confidence_thresholds: (np.array) detections with a confidence >= threshold are kept at each point of the
+            curves.
+        Other arguments are described in match_detections.
+    Return:
+        dict indexed by overlap threshold of dicts with the average precision and the precision, recall and F1 score
+        at each confidence threshold.
+    """
+    det_scores = np.asarray(det_scores, dtype=np.float32)
+    N_gts = len(gt_image_ids)
+    best_truth_jaccard, best_truth_idx = assign_detections(gt_boxes, gt_image_ids, det_boxes, det_image_ids,
+                                                           num_images)
+    order = np.argsort(-det_scores, kind='stable')
+    sorted_scores = det_scores[order]
+    # Number of detections with a confidence >= each threshold.
+    N_kept = np.searchsorted(-sorted_scores, -np.asarray(confidence_thresholds), side='right')
+
+    curves = {}
+    for iou_threshold in iou_thresholds:
+        best_detection_idx = match_assigned_detections(best_truth_jaccard, best_truth_idx, det_scores, N_gts,
+                                                       iou_threshold)
+        is_true_pos = np.zeros(len(det_scores) + 1, dtype=bool)
+        is_true_pos[best_detection_idx.numpy()] = True
+        cum_true_pos = np.concatenate(([0], np.cumsum(is_true_pos[order])))
+
+        # Precision and recall at each distinct confidence, for the average precision.
+        last = np.append(sorted_scores[1:] != sorted_scores[:-1], True)
+        N_detections = np.flatnonzero(last) + 1
+        precision = cum_true_pos[N_detections] / N_detections
+        recall = cum_true_pos[N_detections] / max(N_gts, 1)
+
+        # Precision, recall and F1 score at each confidence threshold.
+        true_pos = cum_true_pos[N_kept]
+        threshold_precision = np.where(N_kept > 0, true_pos / np.maximum(N_kept, 1), 1.)
+        threshold_recall = true_pos / max(N_gts, 1)
+        f1 = 2 * threshold_precision * threshold_recall / np.maximum(threshold_precision + threshold_recall, 1e-12)
+        curves[iou_threshold] = {'Average Precision': average_precision(precision, recall),
+                                 'confidence_thresholds': np.asarray(confidence_thresholds).tolist(),
+                                 'precision': threshold_precision.tolist(),
+                                 'recall': threshold_recall.tolist(),
+                                 'f1': f1.tolist()}
+    return curves
+
+
+def average_precision(precision, recall):
+    """Area under the precision-recall curve, with the precision interpolated as the maximum precision at any higher
+    recall (all-points interpolation of PASCAL VOC)."""
+    recall = np.concatenate(([0.], recall, [1.]))
+    precision = np.concatenate(([0.], precision, [0.]))
+    precision = np.maximum.accumulate(precision[::-1])[::-1]
+    steps = np.flatnonzero(recall[1:] != recall[:-1])
+    return float(np.sum((recall[steps + 1] - recall[steps]) * precision[steps + 1]))
+
+
+def match_image_detections(gt_boxes, det_boxes, det_scores, min_jaccard_overlap=0.5):
+    """Reference implementation of match_detections for a single image, looping over the detections.
+
+    Return:
+        true positives, false positives, false negatives and mean jaccard overlap of the true positives.
+    """
+    N_gts = len(gt_boxes)
+    N_detections = len(det_boxes)
+    if N_detections == 0 or N_gts == 0:
+        return 0, N_detections, N_gts, 0
+
+    # For each detection, find the best ground truth overlap.
+    jaccard_mat = jaccard(to_point_form(gt_boxes), to_point_form(det_boxes))
+    best_truth_jaccard, best_truth_index = jaccard_mat.max(0)
+
+    # For each gt x, find the detection with highest confidence among all detections whose max overlap is x.
+    best_detection_ind = np.zeros(N_gts) * np.nan
+    best_detection_conf = np.zeros(N_gts)
+    for k in range(N_detections):
+        best_gt_ind = best_truth_index[k]
+        if best_truth_jaccard[k] > min_jaccard_overlap and det_scores[k] > best_detection_conf[best_gt_ind]:
+            best_detection_ind[best_gt_ind] = k
+            best_detection_conf[best_gt_ind] = det_scores[k]
+
+    # Remove nans, which correspond to unmatched gt boxes.
+    best_detection_ind = best_detection_ind[~np.isnan(best_detection_ind)].astype(np.int64)
+    true_pos = best_detection_ind.shape[0]
+    truepos_jaccard_mean = np.mean(best_truth_jaccard.numpy()[best_detection_ind]) if true_pos else np.nan
+    return true_pos, N_detections - true_pos, N_gts - true_pos, truepos_jaccard_mean
+
+
+def detection_statistics(all_detections, objects_gt, filenames, num_classes, min_jaccard_overlap=0.5,
+                         pr_iou_thresholds=None):
+    """Statistics of the detections of each class, as saved by evaluate_detections.
+
+    Args:
+        all_detections: (DetectionStore) detections of all images.
+        objects_gt: list indexed by image of ground truths (xmin, xmax, ymin, ymax, class), Shape: [N_gts,5]
+        filenames: list of the image filenames.
+        num_classes: (int) number of classes of the network, including the background.
+        min_jaccard_overlap: (float) minimum jaccard overlap of a true positive.
+        pr_iou_thresholds: list of the jaccard overlap thresholds of the precision-recall curves. The curves are not
+            computed if None.
+    Return:
+        list indexed by object class of dicts with the statistics of the class, or None if there are no ground truths.
+        Images without ground truths are not evaluated.
+    """
+    num_images = len(objects_gt)
+
+    # For each image, calculate
+    # 1) the highest jaccard index for each ground truth.
+    # 2) true positives and false positives/negatives for each class.
+    true_pos = np.nan * np.zeros((num_images, num_classes))
+    false_pos = np.nan * np.zeros((num_images, num_classes))
+    false_neg = np.nan * np.zeros((num_images, num_classes))
+    truepos_jaccard_mean = np.nan * np.zeros((num_images, num_classes))
+
+    # Gather the ground truths of all images.
+    N_objects_gt = np.array([x.shape[0] for x in objects_gt], dtype=int)
+    has_gts = N_objects_gt > 0
+    if not has_gts.any():
+        return None
+    objects_gt = np.concatenate(objects_gt, 0)
+    objects_gt_image_ids = np.repeat(np.arange(num_images), N_objects_gt)
+
+    # Match the detections of each class in all images at once.
+    pr_curves = {}
+    for j in range(1, num_classes):
+        class_gt = objects_gt[:, -1] == (j - 1)
+        rows = all_detections.select(class_id=j)
+        image_true_pos, image_false_pos, image_false_neg, image_jaccard_mean = match_detections(
+            objects_gt[class_gt, :4], objects_gt_image_ids[class_gt], all_detections.boxes[rows],
+            all_detections.image_ids[rows], all_detections.scores[rows], num_images, min_jaccard_overlap)
+        true_pos[has_gts, j] = image_true_pos[has_gts]
+        false_pos[has_gts, j] = image_false_pos[has_gts]
+        false_neg[has_gts, j] = image_false_neg[has_gts]
+        truepos_jaccard_mean[has_gts, j] = image_jaccard_mean[has_gts]
+
+        # Sweep the confidence and overlap thresholds of the detections of the images with ground truths.
+        if pr_iou_thresholds is not None:
+            rows = rows[has_gts[all_detections.image_ids[rows]]]
+            pr_curves[j] = precision_recall_sweep(
+                objects_gt[class_gt, :4], objects_gt_image_ids[class_gt], all_detections.boxes[rows],
+                all_detections.image_ids[rows], all_detections.scores[rows], num_images, pr_iou_thresholds)
+
+    classes_statistics = []
+    for j in range(1, num_classes):
+        class_dict = {}
+        class_dict['N_groundtruths'] = int(np.nansum(true_pos[:, j] + false_neg[:, j]))
+        class_dict['N_detections'] = int(np.nansum(true_pos[:, j] + false_pos[:, j]))
+        class_dict['True Positives'] = int(np.nansum(true_pos[:, j]))
+        class_dict['False Positives'] = int(np.nansum(false_pos[:, j]))
+        class_dict['False Negatives'] = int(np.nansum(false_neg[:, j]))
+        class_dict['Precision'] = class_dict['True Positives'] / (
+                class_dict['True Positives'] + class_dict['False Positives'])
+        class_dict['Recall'] = class_dict['True Positives'] / (
+                class_dict['True Positives'] + class_dict['False Negatives'])
+        class_dict['Jaccard_TruePos_Average'] = np.nanmean(truepos_jaccard_mean[:, j])
+
+        # Images without ground truths are not evaluated.
+        total_false = np.nan_to_num(false_pos[:, j] + false_neg[:, j], nan=-1)
+        worst_image_id = np.argmax(total_false)
+
+        class_dict['Highest False Pos + Neg Image'] = filenames[worst_image_id]
+        class_dict['Highest Error Image: False positives'] = int(false_pos[worst_image_id, j])
+        class_dict['Highest Error Image: False negatives'] = int(false_neg[worst_image_id, j])
+
+        if pr_iou_thresholds is not None:
+            class_dict['Average Precision'] = {str(iou_threshold): curves['Average Precision']
+                                               for iou_threshold, curves in pr_curves[j].items()}
+            class_dict['Precision-Recall Curves'] = {
+                str(iou_threshold): {key: value for key, value in curves.items() if key != 'Average Precision'}
+                for iou_threshold, curves in pr_curves[j].items()}
+
+        classes_statistics.append(class_dict)
+    return classes_statistics
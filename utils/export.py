@@ -0,0 +1,126 @@
+# Export of a trained network to TorchScript and ONNX.
+import torch
+import torch.nn as nn
+
+# Extra file of the TorchScript archive telling whether the base, extra and multibox layers can be fused on load.
+FUSE_HEADS_FILENAME = 'fuse_heads'
+
+
+class SSDHeads(nn.Module):
+    """Base, extra and multibox layers of an SSD network, returning the location predictions and the class
+    confidences after softmax.
+
+    Arguments:
+        net: SSD network.
+    """
+
+    def __init__(self, net):
+        super(SSDHeads, self).__init__()
+        self.net = net
+
+    def forward(self, x):
+        loc, conf = self.net.predict(x)
+        # The outputs are in fp32 when the network runs in mixed precision, as in SSD.forward.
+        return loc.float(), torch.softmax(conf.float(), -1)
+
+
+class ExportedSSD(nn.Module):
+    """SSD network in test phase made of a traced SSDHeads module and the scriptable detection layer.
+
+    Arguments:
+        heads: traced SSDHeads module.
+        detect: detection layer of the network.
+        priors: (tensor) prior boxes in center-offset form, Shape: [num_priors,4]
+    """
+
+    def __init__(self, heads, detect, priors):
+        super(ExportedSSD, self).__init__()
+        self.heads = heads
+        self.detect = detect
+        self.register_buffer('priors', priors)
+
+    def forward(self, x):
+        loc, conf = self.heads(x)
+        # Decode the boxes in fp32 when the module runs in mixed precision.
+        return self.detect(loc.float(), conf.float(), self.priors)
+
+
+class FusedSSD(nn.Module):
+    """Exported SSD network whose base, extra and multibox layers are frozen and run with oneDNN Graph fusion on the
+    CPU, which fuses each convolution with its ReLU activation. The fusion groups are compiled during the first two
+    calls.
+
+    The detection layer runs without fusion, since its indexing ops are not supported by oneDNN Graph. In mixed
+    precision, the exported module runs unchanged, since the fused graph does not support autocast.
+
+    Arguments:
+        module: ExportedSSD module loaded by load_torchscript.
+    """
+
+    def __init__(self, module):
+        super(FusedSSD, self).__init__()
+        self.module = module
+        self.heads = torch.jit.freeze(module.heads)
+        self.detect = module.detect
+        self.register_buffer('priors', module.priors)
+
+    def forward(self, x):
+        if torch.is_autocast_enabled('cpu'):
+            return self.module(x)
+        with torch.jit.fuser('fuser3'):
+            loc, conf = self.heads(x)
+        return self.detect(loc, conf, self.priors)
+
+
+def example_input(net):
+    return torch.zeros(1, 3, net.size, net.size, device=next(net.parameters()).device)
+
+
+def export_torchscript(net, filepath, heads=None):
+    """
+    Export a network in test phase to a TorchScript module, which is loaded without the source code of the
+    network (see load_torchscript). The base, extra and multibox layers are traced and the detection layer is
+    scripted, so that its data-dependent control flow is preserved. The base, extra and multibox layers of a network
+    built in optimized mode are fused when the module is loaded on the CPU (see FusedSSD).
+    :param net: SSD network in test phase.
+    :param filepath: path of the TorchScript file.
+    :param heads: module replacing the SSDHeads of the network, such as its quantized version.
+    :return: exported module.
+    """
+    if net.phase != 'test':
+        raise ValueError('Only networks in test phase can be exported.')
+    net.eval()
+    fuse_heads = heads is None and net.channels_last
+    with torch.no_grad():
+        heads = torch.jit.trace(heads if heads is not None else SSDHeads(net), example_input(net))
+    module = torch.jit.script(ExportedSSD(heads, net.detect, net.priors.data.clone()))
+    torch.jit.save(module, filepath, _extra_files={FUSE_HEADS_FILENAME: str(fuse_heads).lower()})
+    return module
+
+
+def export_onnx(net, filepath, opset_version=17):
+    """
+    Export the base, extra and multibox layers of a network to an ONNX graph with a dynamic batch size. The graph
+    outputs the location predictions and class confidences, which are decoded with the prior boxes by the detection
+    layer. Requires the onnx package.
+    :param net: SSD network.
+    :param filepath: path of the ONNX file.
+    """
+    net.eval()
+    with torch.no_grad():
+        torch.onnx.export(SSDHeads(net), example_input(net), filepath, input_names=['image'],
+                          output_names=['loc', 'conf'], opset_version=opset_version, dynamo=False,
+                          dynamic_axes={'image': {0: 'batch'}, 'loc': {0: 'batch'}, 'conf': {0: 'batch'}})
+
+
+def load_torchscript(filepath, cuda=False):
+    """
+    Load a network exported by export_torchscript.
+    :return: TorchScript module in evaluation mode, wrapped in FusedSSD if its layers are fused on the CPU.
+    """
+    extra_files = {FUSE_HEADS_FILENAME: ''}
+    module = torch.jit.load(filepath, map_location='cuda' if cuda else 'cpu', _extra_files=extra_files)
+    module.eval()
+    if extra_files[FUSE_HEADS_FILENAME] == b'true' and not cuda:
+        return FusedSSD(module)
+    return module
@@ -0,0 +1,96 @@
+# Detection of the objects in the images of a dataset.
+import numpy as np
+import torch
+import torch.backends.cudnn as cudnn
+import torch.utils.data as data
+from torch.autograd import Variable
+from data import detection_collate
+from ssd import build_ssd
+from .export import load_torchscript
+from .tiling import detect_tiled
+from .detection_writer import scale_detections, gather_detections
+from .detection_store import DetectionStoreBuilder
+from .precision import autocast
+
+
+def load_network(config, model_format=None, cuda=None):
+    """
+    Load the trained network of config.eval.model_name in test phase.
+    :param model_format: 'state_dict' of the network or 'torchscript' module exported by export.py or quantize.py.
+    Defaults to config.eval.model_format.
+    :param cuda: move the network to the GPU. Defaults to config.eval.cuda.
+    :return: network in evaluation mode.
+    """
+    model_format = model_format or config.eval.model_format
+    cuda = config.eval.cuda if cuda is None else cuda
+    if model_format == 'torchscript':
+        net = load_torchscript(config.eval.model_name, cuda)
+    elif model_format == 'state_dict':
+        net = build_ssd('test', config.model)
+        if cuda:
+            Map_loc = lambda storage, loc: storage
+        else:
+            Map_loc = 'cpu'
+        state_dict = torch.load(config.eval.model_name, map_location=Map_loc)
+        if 'net_state' in state_dict.keys():
+            state_dict = state_dict['net_state']
+        net.load_state_dict(state_dict)
+        net.eval()
+    else:
+        raise ValueError("eval_model_format must be 'state_dict' or 'torchscript'.")
+
+    if cuda:
+        net = net.cuda()
+        cudnn.benchmark = True
+    return net
+
+
+def iter_image_detections(config, net, dataset, indices=None):
+    """Generator of the index of each image and its detections.
+
+    The images are decoded by the DataLoader workers while the network processes the previous batch.
+    :param indices: indices of the images to process. All images are processed if None.
+    :return: index of the image and list indexed by class of detections (score, xmin, ymin, xmax, ymax) in pixels.
+    """
+    if indices is None:
+        indices = list(range(len(dataset)))
+    if config.eval.tiled:
+        # Slide the network input window over the full-size images. The tiles of each image are batched.
+        dataset_pixel_means = np.array(config.model.pixel_means, dtype=np.float32)
+        for i in indices:
+            with autocast(config.eval.precision, config.eval.cuda):
+                image_detections = detect_tiled(net, dataset.get_image(i), config.model.input_size,
+                                                config.eval.tile_overlap, dataset_pixel_means, config.eval.batch_size,
+                                                net.detect.nms_thresh, config.eval.cuda)
+            yield i, image_detections
+        return
+
+    data_loader = data.DataLoader(data.Subset(dataset, indices), config.eval.batch_size,
+                                  num_workers=config.eval.num_workers, shuffle=False, collate_fn=detection_collate,
+                                  pin_memory=config.eval.cuda)
+    i = 0
+    for images, _ in data_loader:
+        h, w = images.size()[2:]
+        x = Variable(images)
+        if config.eval.cuda:
+            x = x.cuda()
+
+        # Get neural net detections and scale the boxes dimensions with the image height/width.
+        with torch.no_grad(), autocast(config.eval.precision, config.eval.cuda):
+            detections = net(x).data
+        for k in range(detections.size(0)):
+            yield indices[i], [scale_detections(detections[k, j, :], w, h) for j in range(detections.size(1))]
+            i += 1
+
+
+def collect_detections(config, net, dataset, indices):
+    """
+    Detect the objects of a subset of images.
+    :param indices: indices of the images to process.
+    :return: DetectionStore of the detections, where image k is the image indices[k].
+    """
+    all_detections = DetectionStoreBuilder(len(indices))
+    for k, (_, image_detections) in enumerate(iter_image_detections(config, net, dataset, indices)):
+        class_type, scores, box_limits = gather_detections(image_detections)
+        all_detections.append(k, class_type + 1, scores, box_limits)
+    return all_detections.build()
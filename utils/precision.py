@@ -0,0 +1,30 @@
+# Mixed precision training and inference.
+import torch
+
+# Data type of the autocast regions of each precision.
+PRECISIONS = {'fp32': torch.float32, 'bf16': torch.bfloat16, 'fp16': torch.float16}
+
+
+def check_precision(precision):
+    if precision not in PRECISIONS:
+        raise ValueError('precision must be one of {}.'.format(tuple(PRECISIONS)))
+
+
+def autocast(precision, cuda=False):
+    """
+    Context manager running the convolutions of the enclosed region in the given precision. The other ops run in
+    the data type of their inputs or in fp32, following the autocast policy of the device.
+    :param precision: 'fp32', 'bf16' or 'fp16'.
+    :param cuda: run on a CUDA device.
+    """
+    check_precision(precision)
+    return torch.autocast('cuda' if cuda else 'cpu', dtype=PRECISIONS[precision], enabled=precision != 'fp32')
+
+
+def grad_scaler(precision, cuda=False):
+    """
+    Gradient scaler of the training loop. The loss is scaled only in fp16, whose narrow exponent range flushes small
+    gradients to zero. bf16 has the exponent range of fp32 and does not need a scaler.
+    """
+    check_precision(precision)
+    return torch.amp.GradScaler('cuda' if cuda else 'cpu', enabled=precision == 'fp16')
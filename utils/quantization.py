@@ -0,0 +1,29 @@
+# Post-training static quantization of a trained network for CPU inference.
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+from .export import SSDHeads, example_input
+
+
+def quantize_heads(net, calibration_batches, backend=None):
+    """
+    Quantize the weights and activations of the base, extra and multibox layers of a network to int8.
+
+    The layers are traced with torch.fx, which fuses each convolution with its ReLU activation. Observers then
+    record the range of the activations on the calibration images to set the quantization parameters. The L2Norm
+    layer and the softmax of the class confidences run in fp32.
+    :param net: SSD network in test phase, on the CPU.
+    :param calibration_batches: iterable of batches of transformed images, Shape: [batch,3,size,size]
+    :param backend: quantized engine, such as 'x86' or 'qnnpack'. Defaults to torch.backends.quantized.engine.
+    :return: quantized SSDHeads module, which can be exported with export_torchscript.
+    """
+    backend = backend or torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(torch.softmax, None) \
+        .set_module_name('net.L2Norm', None)
+    net.eval()
+    prepared = prepare_fx(SSDHeads(net), qconfig_mapping, (example_input(net),))
+    with torch.no_grad():
+        for x in calibration_batches:
+            prepared(x)
+    return convert_fx(prepared)
@@ -0,0 +1,115 @@
+# Cache of the detections of each image.
+import hashlib
+import json
+import os
+import os.path as osp
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+ENTRY_EXTENSION = '.npz'
+
+
+def state_dict_hash(state_dict):
+    # Hash of the names and values of the network weights.
+    digest = hashlib.sha256()
+    for name in sorted(state_dict.keys()):
+        digest.update(name.encode())
+        digest.update(state_dict[name].detach().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def file_hash(filepath, chunk_size=1 << 20):
+    # Hash of the content of a file, such as a TorchScript module whose state_dict misses the packed weights.
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_hash(config_dict):
+    return hashlib.sha256(json.dumps(config_dict, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache(object):
+    """Content-addressed cache of the detections of each image on disk.
+
+    An entry is keyed by the hash of the encoded image bytes and a model key, made of the hashes of the network
+    weights and of the configurations that change the detections. A changed image or model therefore misses the
+    cache instead of reusing stale results. The least recently used entries are removed when the cache grows above
+    max_size.
+
+    Arguments:
+        cache_dir (str): directory where the entries are saved.
+        max_size (int): maximum size of the cache in bytes.
+        model_key (str): hash identifying the model weights and configurations.
+    """
+
+    def __init__(self, cache_dir, max_size, model_key):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.model_key = model_key
+        if not osp.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Entries ordered from the least to the most recently used, with their size.
+        entries = []
+        for filename in os.listdir(cache_dir):
+            if filename.endswith(ENTRY_EXTENSION) and not filename.endswith('.tmp' + ENTRY_EXTENSION):
+                stat = os.stat(osp.join(cache_dir, filename))
+                entries.append((stat.st_mtime_ns, filename[:-len(ENTRY_EXTENSION)], stat.st_size))
+        self.entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.size = sum(self.entries.values())
+
+    def key(self, image_bytes):
+        return hashlib.sha256(self.model_key.encode() + hashlib.sha256(image_bytes).digest()).hexdigest()
+
+    def entry_path(self, key):
+        return osp.join(self.cache_dir, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        """
+        Load the detections of an image.
+        :return: dict of the cached arrays, or None if the entry is missing or corrupted.
+        """
+        if key not in self.entries:
+            return None
+        path = self.entry_path(key)
+        try:
+            with np.load(path) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+            # The modification time records the last use of the entry.
+            os.utime(path)
+        except (OSError, ValueError, EOFError, zipfile.BadZipFile):
+            # A corrupted entry is a cache miss.
+            self.remove(key)
+            return None
+        self.entries.move_to_end(key)
+        return arrays
+
+    def put(self, key, **arrays):
+        # Write to a temporary file first so that an interrupted write does not leave a corrupted entry.
+        path = self.entry_path(key)
+        tmp_path = osp.join(self.cache_dir, key + '.tmp' + ENTRY_EXTENSION)
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+        self.size += os.path.getsize(path) - self.entries.pop(key, 0)
+        self.entries[key] = os.path.getsize(path)
+        self.evict()
+
+    def evict(self):
+        # Remove the least recently used entries until the cache fits in max_size.
+        while self.size > self.max_size and self.entries:
+            self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        self.size -= self.entries.pop(key)
+        try:
+            os.remove(self.entry_path(key))
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.entries)
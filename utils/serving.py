@@ -0,0 +1,186 @@
+# Inference service answering detection requests over HTTP.
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+import cv2
+import numpy as np
+import torch
+from data import base_transform
+from .precision import autocast
+
+# Number of recent batches whose size is recorded.
+BATCH_SIZES_HISTORY = 1000
+
+
+class MicroBatcher(object):
+    """Coalesce concurrent requests into batches processed by a single worker thread.
+
+    A batch is processed as soon as it holds max_batch_size images, or when max_latency seconds have passed since
+    its first request arrived, whichever comes first.
+
+    Arguments:
+        predict (function): function returning the results of a list of inputs.
+        max_batch_size (int): maximum number of inputs per batch.
+        max_latency (float): maximum time in seconds a request waits for the batch to fill.
+    """
+
+    def __init__(self, predict, max_batch_size=8, max_latency=0.01):
+        self.predict = predict
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        # Sizes of the recent batches.
+        self.batch_sizes = deque(maxlen=BATCH_SIZES_HISTORY)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, x):
+        """
+        Queue an input.
+        :return: Future of the result.
+        """
+        future = Future()
+        self.queue.put((x, future))
+        return future
+
+    def __call__(self, x):
+        return self.submit(x).result()
+
+    def next_batch(self):
+        # Wait for the first request, then fill the batch until the deadline.
+        batch = [self.queue.get()]
+        if batch[0] is None:
+            return None
+        deadline = time.monotonic() + self.max_latency
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # Process the current batch before stopping.
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            if batch is None:
+                break
+            inputs = [x for x, _ in batch]
+            self.batch_sizes.append(len(inputs))
+            try:
+                results = self.predict(inputs)
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class SSDPredictor(object):
+    """Detect the objects of a list of BGR images with an SSD network in test phase.
+
+    The results are lists of dicts with the class, score and box limits (xmin, xmax, ymin, ymax) in pixels of the
+    original image.
+
+    Arguments:
+        net: SSD network in test phase.
+        config (object): configuration object created from config.py
+    """
+
+    def __init__(self, net, config):
+        self.net = net
+        self.size = config.model.input_size
+        self.mean = np.array(config.model.pixel_means, dtype=np.float32)
+        self.classes_name = config.dataset.classes_name
+        self.cuda = config.eval.cuda
+        self.precision = config.eval.precision
+
+    def __call__(self, images):
+        x = torch.from_numpy(np.stack([base_transform(image, self.size, self.mean) for image in images]))
+        x = x.permute(0, 3, 1, 2)
+        if self.cuda:
+            x = x.cuda()
+        with torch.no_grad(), autocast(self.precision, self.cuda):
+            detections = self.net(x).data.cpu()
+
+        results = []
+        for image, image_detections in zip(images, detections):
+            h, w = image.shape[:2]
+            objects = []
+            # Skip j = 0 (background class).
+            for j in range(1, image_detections.size(0)):
+                dets = image_detections[j]
+                dets = dets[dets[:, 0] > 0]
+                for score, xmin, ymin, xmax, ymax in dets.tolist():
+                    objects.append({'class': self.classes_name[j - 1], 'class_id': j - 1, 'class_score': score,
+                                    'xmin': xmin * w, 'xmax': xmax * w, 'ymin': ymin * h, 'ymax': ymax * h})
+            results.append(objects)
+        return results
+
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+    """Handle POST /detect requests whose body is an encoded image and GET /health requests."""
+    batcher = None
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self.send_json(200, {'status': 'ok'})
+        else:
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+
+    def do_POST(self):
+        if urlparse(self.path).path != '/detect':
+            self.send_json(404, {'error': 'Unknown path {}'.format(self.path)})
+            return
+        image_bytes = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        image = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            self.send_json(400, {'error': 'The request body is not an image.'})
+            return
+        try:
+            objects = self.batcher(image)
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {'height': image.shape[0], 'width': image.shape[1], 'detections': objects})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(batcher, host='127.0.0.1', port=8000):
+    """
+    Create the HTTP server of a batcher. Each request is handled in its own thread, so that concurrent requests
+    are batched together.
+    :return: ThreadingHTTPServer. Call serve_forever() to start it.
+    """
+    handler = type('Handler', (DetectionRequestHandler,), {'batcher': batcher})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
@@ -0,0 +1,181 @@
+# Streaming detection of the images arriving in a directory.
+import os
+import os.path as osp
+import queue
+import threading
+import time
+
+import cv2
+import numpy as np
+import torch
+from data import base_transform
+from .detection_writer import DetectionWriter, scale_detections, gather_detections
+from .precision import autocast
+
+PROGRESS_FILENAME = '.processed_images'
+
+
+class ProgressJournal(object):
+    """Append-only record of the processed images, used to resume streaming after a restart.
+
+    Each line holds the filename, modification time and size of a processed image. An image is processed again if
+    its file changed.
+
+    Arguments:
+        filepath (str): path of the journal file.
+    """
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.processed = {}
+        self.lock = threading.Lock()
+        if osp.isfile(filepath):
+            with open(filepath) as file:
+                for line in file:
+                    fields = line.rstrip('\n').split('\t')
+                    # Skip a line truncated by an interruption.
+                    if len(fields) == 3 and line.endswith('\n'):
+                        self.processed[fields[0]] = (int(fields[1]), int(fields[2]))
+        self.file = open(filepath, 'a')
+
+    def is_processed(self, filename, signature):
+        return self.processed.get(filename) == signature
+
+    def add(self, filename, signature):
+        with self.lock:
+            self.file.write('{}\t{:d}\t{:d}\n'.format(filename, *signature))
+            self.file.flush()
+            self.processed[filename] = signature
+
+    def close(self):
+        self.file.close()
+
+
+class FolderWatcher(threading.Thread):
+    """Thread polling a directory for new or changed JPEG images and queuing them once decoded.
+
+    A file is queued once its modification time and size are unchanged between two polls, so that images are not
+    read while they are being written. The queue is bounded: when the inference falls behind, the watcher blocks
+    until there is room in the queue.
+
+    Arguments:
+        watch_dir (str): directory to watch.
+        image_queue (queue.Queue): bounded queue receiving (filename, signature, image) items.
+        journal (ProgressJournal): record of the processed images.
+        poll_interval (float): time in seconds between two scans of the directory.
+        stop_event (threading.Event): event stopping the watcher when set.
+    """
+
+    def __init__(self, watch_dir, image_queue, journal, poll_interval, stop_event):
+        super(FolderWatcher, self).__init__(daemon=True)
+        self.watch_dir = watch_dir
+        self.image_queue = image_queue
+        self.journal = journal
+        self.poll_interval = poll_interval
+        self.stop_event = stop_event
+        self.candidates = {}
+        self.queued = {}
+
+    def scan(self):
+        # Signature (modification time, size) of each JPEG image of the directory.
+        signatures = {}
+        for entry in os.scandir(self.watch_dir):
+            if entry.is_file() and entry.name.lower().endswith('.jpg'):
+                stat = entry.stat()
+                signatures[osp.splitext(entry.name)[0]] = (stat.st_mtime_ns, stat.st_size)
+        return signatures
+
+    def run(self):
+        while not self.stop_event.is_set():
+            signatures = self.scan()
+            for filename, signature in sorted(signatures.items()):
+                if self.journal.is_processed(filename, signature) or self.queued.get(filename) == signature:
+                    continue
+                if self.candidates.get(filename) != signature:
+                    # Wait until the file is stable.
+                    continue
+                image = cv2.imread(osp.join(self.watch_dir, filename + '.jpg'))
+                self.queued[filename] = signature
+                if image is None:
+                    print('WARNING: {}.jpg could not be decoded.'.format(filename))
+                    continue
+                while not self.stop_event.is_set():
+                    try:
+                        self.image_queue.put((filename, signature, image), timeout=self.poll_interval)
+                        break
+                    except queue.Full:
+                        pass
+            self.candidates = signatures
+            self.stop_event.wait(self.poll_interval)
+
+
+def next_batch(image_queue, batch_size, timeout):
+    # Wait for the first image, then take the images already queued.
+    batch = [image_queue.get(timeout=timeout)]
+    while len(batch) < batch_size:
+        try:
+            batch.append(image_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def stream_detections(config, net, watch_dir, detections_dir, batch_size=8, queue_size=32, poll_interval=1.,
+                      stop_event=None):
+    """
+    Detect the objects of the images arriving in a directory until stop_event is set.
+
+    The detections of each image are saved in a CSV file of detections_dir, in the format of eval.py. The processed
+    images are recorded in a journal of detections_dir, so that a restarted stream skips them.
+    :param config: configuration object created from config.py
+    :param net: SSD network in test phase.
+    :param watch_dir: directory where the images arrive.
+    :param detections_dir: directory where the detections are saved.
+    :param batch_size: maximum number of images per forward pass.
+    :param queue_size: maximum number of decoded images waiting for the network.
+    :param poll_interval: time in seconds between two scans of watch_dir.
+    :param stop_event: (threading.Event) event stopping the stream.
+    :return: number of processed images.
+    """
+    if not osp.isdir(detections_dir):
+        os.makedirs(detections_dir)
+    stop_event = stop_event or threading.Event()
+    mean = np.array(config.model.pixel_means, dtype=np.float32)
+    detections_column_names = list(config.dataset.object_properties) + ['class_score']
+
+    journal = ProgressJournal(osp.join(detections_dir, PROGRESS_FILENAME))
+    image_queue = queue.Queue(queue_size)
+    watcher = FolderWatcher(watch_dir, image_queue, journal, poll_interval, stop_event)
+    watcher.start()
+    N_processed = 0
+    try:
+        with DetectionWriter(detections_column_names, queue_size) as writer:
+            while not stop_event.is_set():
+                try:
+                    batch = next_batch(image_queue, batch_size, poll_interval)
+                except queue.Empty:
+                    continue
+                t0 = time.time()
+                x = torch.from_numpy(np.stack([base_transform(image, config.model.input_size, mean)
+                                               for _, _, image in batch])).permute(0, 3, 1, 2)
+                if config.eval.cuda:
+                    x = x.cuda()
+                with torch.no_grad(), autocast(config.eval.precision, config.eval.cuda):
+                    detections = net(x).data.cpu()
+
+                for (filename, signature, image), image_detections in zip(batch, detections):
+                    h, w = image.shape[:2]
+                    class_type, scores, box_limits = gather_detections(
+                        [scale_detections(image_detections[j], w, h) for j in range(image_detections.size(0))])
+                    filepath = osp.join(detections_dir, filename + '.csv')
+                    # The image is recorded as processed only once its detections are written.
+                    writer.put(filepath, np.column_stack((box_limits, class_type, scores)).astype(np.float32),
+                               lambda filename=filename, signature=signature: journal.add(filename, signature))
+                N_processed += len(batch)
+                print('Processed {:d} images in {:.3f}s ({:d} processed, {:d} queued)'.format(
+                    len(batch), time.time() - t0, N_processed, image_queue.qsize()))
+    finally:
+        stop_event.set()
+        watcher.join()
+        journal.close()
+    return N_processed
@@ -0,0 +1,102 @@
+# Tiled inference on images larger than the network input size.
+import numpy as np
+import torch
+from torchvision.ops import batched_nms
+
+
+def tile_positions(length, tile_size, overlap):
+    """Start positions of the tiles covering an image dimension.
+
+    Consecutive tiles overlap by at least `overlap` pixels and the last tile is flush with the image border.
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError('The tile overlap must be in [0, {}).'.format(tile_size))
+    if length <= tile_size:
+        return [0]
+    stride = tile_size - overlap
+    positions = list(range(0, length - tile_size, stride))
+    positions.append(length - tile_size)
+    return positions
+
+
+def iter_tiles(image, tile_size, overlap, mean):
+    """Generator of the mean-subtracted tiles of an image and their (x, y) offset in the image.
+
+    Tiles that extend past the image border are padded with the mean pixel value.
+    """
+    height, width, N_channels = image.shape
+    for y in tile_positions(height, tile_size, overlap):
+        for x in tile_positions(width, tile_size, overlap):
+            crop = image[y:y + tile_size, x:x + tile_size]
+            tile = np.zeros((tile_size, tile_size, N_channels), dtype=np.float32)
+            tile[:crop.shape[0], :crop.shape[1]] = crop - mean
+            yield tile, x, y
+
+
+def iter_tile_batches(image, tile_size, overlap, mean, batch_size):
+    """Generator of batches of tiles, Shape: [batch,C,tile_size,tile_size], and their list of (x, y) offsets."""
+    tiles = []
+    offsets = []
+    for tile, x, y in iter_tiles(image, tile_size, overlap, mean):
+        tiles.append(tile)
+        offsets.append((x, y))
+        if len(tiles) == batch_size:
+            yield torch.from_numpy(np.stack(tiles)).permute(0, 3, 1, 2), offsets
+            tiles = []
+            offsets = []
+    if tiles:
+        yield torch.from_numpy(np.stack(tiles)).permute(0, 3, 1, 2), offsets
+
+
+def detect_tiled(net, image, tile_size, overlap, mean, batch_size, nms_thresh, cuda=False):
+    """Detect objects in an image of arbitrary size by sliding the network input window over it.
+
+    Tiles are streamed through the network in batches so that memory stays bounded by the batch size. Detections are
+    mapped back to image coordinates and the duplicates found in overlapping tiles are merged with nms.
+
+    Args:
+        net: SSD network in test phase.
+        image: (np.array) BGR image, Shape: [H,W,C].
+        tile_size: (int) Size of the square tiles. Should match the network input size.
+        overlap: (int) Minimum overlap in pixels between neighbouring tiles. Objects smaller than the overlap are
+            fully contained in at least one tile.
+        mean: (np.array) Pixel means subtracted from the image.
+        batch_size: (int) Number of tiles processed per forward pass.
+        nms_thresh: (float) Overlap threshold used to merge detections across tiles.
+        cuda: (bool) Run the network on the GPU.
+    Return:
+        list of tensors indexed by class of detections (score, xmin, ymin, xmax, ymax) in pixels. The background
+        class (0) is empty.
+    """
+    height, width, _ = image.shape
+    boxes = []
+    scores = []
+    classes = []
+    for batch, offsets in iter_tile_batches(image, tile_size, overlap, mean, batch_size):
+        if cuda:
+            batch = batch.cuda()
+        with torch.no_grad():
+            detections = net(batch).data.cpu()
+        num_classes = detections.size(1)
+
+        # Map the detections of each tile to image coordinates.
+        offsets = torch.Tensor(offsets).repeat(1, 2)  # (x, y, x, y)
+        mask = detections[..., 0].gt(0)
+        tile_idx, class_idx, _ = mask.nonzero(as_tuple=True)
+        kept = detections[mask]
+        boxes.append(kept[:, 1:] * tile_size + offsets[tile_idx])
+        scores.append(kept[:, 0])
+        classes.append(class_idx)
+
+    boxes = torch.cat(boxes)
+    scores = torch.cat(scores)
+    classes = torch.cat(classes)
+
+    # Merge the duplicates across tile seams and clip the boxes to the image.
+    keep = batched_nms(boxes, scores, classes, nms_thresh)
+    boxes = boxes[keep]
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(min=0, max=width)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(min=0, max=height)
+    detections = torch.cat((scores[keep].unsqueeze(1), boxes), 1)
+    classes = classes[keep]
+    return [detections[classes == j] for j in range(num_classes)]
@@ -0,0 +1,41 @@
+"""Detect the objects of the images arriving in a directory.
+
+    New or changed JPEG images of the watched directory are processed in batches and their detections are saved in
+    CSV files, in the format of eval.py. A restarted stream skips the images already processed.
+"""
+import argparse
+
+from data.config import build_config
+from utils.inference import load_network
+from utils.streaming import stream_detections
+
+parser = argparse.ArgumentParser(
+    description='Single Shot MultiBox Detector Streaming Detection')
+parser.add_argument('--config', type=str,
+                    help='Name of configuration file.')
+parser.add_argument('--watch_dir', default=None, type=str,
+                    help='Directory where the images arrive. Defaults to dataset_images_dir.')
+parser.add_argument('--output_dir', default=None, type=str,
+                    help='Directory where the detections are saved. Defaults to output_detections_dir.')
+parser.add_argument('--batch_size', default=None, type=int,
+                    help='Maximum number of images per forward pass. Defaults to eval_batch_size.')
+parser.add_argument('--queue_size', default=32, type=int,
+                    help='Maximum number of decoded images waiting for the network')
+parser.add_argument('--poll_interval', default=1., type=float,
+                    help='Time in seconds between two scans of the watched directory')
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    configs = build_config(args.config)
+
+    # Load neural net.
+    net = load_network(configs)
+
+    watch_dir = args.watch_dir or configs.dataset.images_dir
+    output_dir = args.output_dir or configs.output.detections_dir
+    batch_size = args.batch_size or configs.eval.batch_size
+    print('Watching {} for new images. Detections are saved in {}.'.format(watch_dir, output_dir))
+    try:
+        stream_detections(configs, net, watch_dir, output_dir, batch_size, args.queue_size, args.poll_interval)
+    except KeyboardInterrupt:
+        pass